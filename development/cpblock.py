@@ -6,47 +6,211 @@
 ##############################################################################
 
 
+import errno
+import mmap
 import os
 import re
+import threading
+
+try:
+    import ctypes
+    import ctypes.util
+    _libc = ctypes.CDLL( ctypes.util.find_library( 'c' ), use_errno = True )
+except ( ImportError, OSError ):
+    _libc = None
+
+
+# number of bytes to copy at a time when the kernel can not copy for us
+copy_chunk = 1048576
+
+# errors indicating a kernel copy is not supported for a pair of files
+_unsupported = (
+    errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.ENOTSUP, errno.EOPNOTSUPP
+)
 
 
 #=============================================================================
 def cpblock( infile, block, outfile ):
 
-    ifh = open( infile, 'rb' )
-    ofh = open( outfile, 'wb' )
+    return cpblocks( infile, [ ( block, outfile ) ] )[ 0 ]
 
-    if block.find( ',' ) != -1:
-        ( start, stop ) = block.split( ',', 1 )
-        start  = getoffset( start )
-        length = getoffset( stop ) - start
 
-    else:
-        ( start, length ) = block.split( ':', 1 )
-        start  = getoffset( start )
-        length = getoffset( length )
+#=============================================================================
+def cpblocks( infile, blocks, jobs = 1, errors = None ):
+    """
+    Copy many blocks from one input file to separate output files.
+    @param infile Path to the input file
+    @param blocks List of ( block specifier, output path ) pairs
+    @param jobs Number of blocks to copy at the same time
+    @param errors Optional list that receives the exception raised while
+                  copying each block (None for each block that was copied).
+                  Without it, the first failed block's exception is raised.
+    @return List of the number of bytes copied to each output file
+    """
+
+    ifh    = open( infile, 'rb' )
+    lock   = threading.Lock()
+    copied = [ 0 ] * len( blocks )
+    failed = [ None ] * len( blocks )
+    queue  = iter( range( len( blocks ) ) )
 
-    ifh.seek( start, os.SEEK_SET )
-    copied = cpbytes( ofh, ifh, length )
+    def worker():
+        while True:
+            with lock:
+                try:
+                    index = next( queue )
+                except StopIteration:
+                    return
+            try:
+                ( block, outfile ) = blocks[ index ]
+                ( start, length )  = getblock( block )
+                with open( outfile, 'wb' ) as ofh:
+                    copied[ index ] = cprange( ofh, ifh, start, length, lock )
+            except Exception as error:
+                failed[ index ] = error
+
+    threads = [ threading.Thread( target = worker ) for i in range( jobs ) ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
 
-    ofh.close()
     ifh.close()
 
+    # report each failed block, or the first failed block (in block order)
+    if errors is not None:
+        errors[ : ] = failed
+    else:
+        for error in failed:
+            if error is not None:
+                raise error
+
     return copied
 
 
 #=============================================================================
 def cpbytes( target_handle, source_handle, length ):
-    copy_chunk = 4096
-    if length > copy_chunk:
-        copied = 0
+    copied = 0
+    while copied < length:
+        data = source_handle.read( min( copy_chunk, ( length - copied ) ) )
+        if len( data ) == 0:
+            break
+        target_handle.write( data )
+        copied += len( data )
+    return copied
+
+
+#=============================================================================
+def cprange( target_handle, source_handle, start, length, lock = None ):
+    """
+    Copy a range of bytes from one file to another.  The kernel copies the
+    data directly when possible (copy_file_range or sendfile, called through
+    ctypes when the os module does not provide them).  Otherwise, the data
+    is copied in chunks from positioned reads or a memory map.  The source
+    file's position is not used, so many copies may share one source handle.
+    @param target_handle Output file handle
+    @param source_handle Input file handle
+    @param start Byte offset of the range in the input file
+    @param length Number of bytes to copy
+    @param lock Lock that serializes seeking and reading the source handle
+                (only needed when the source can not be memory mapped)
+    @return Number of bytes copied
+    """
+
+    target = target_handle.fileno()
+    source = source_handle.fileno()
+    copied = 0
+
+    # kernel copies, falling back when unsupported for these files
+    for kernel_copy in ( _copy_file_range, _sendfile ):
+        try:
+            while copied < length:
+                count = kernel_copy(
+                    target, source, ( start + copied ), ( length - copied )
+                )
+                if count == 0:
+                    return copied
+                copied += count
+            return copied
+        except OSError as error:
+            if error.errno not in _unsupported:
+                raise
+
+    # continue writing after anything the kernel copied
+    if copied > 0:
+        target_handle.seek( os.lseek( target, 0, os.SEEK_CUR ) )
+
+    # chunked copy using positioned reads
+    if hasattr( os, 'pread' ):
         while copied < length:
-            target_handle.write( source_handle.read( copy_chunk ) )
-            copied += copy_chunk
+            data = os.pread(
+                source,
+                min( copy_chunk, ( length - copied ) ),
+                ( start + copied )
+            )
+            if len( data ) == 0:
+                break
+            target_handle.write( data )
+            copied += len( data )
         return copied
 
-    target_handle.write( source_handle.read( length ) )
-    return length
+    # chunked copy from a memory map of the range
+    try:
+        return copied + _cpmap(
+            target_handle, source, ( start + copied ), ( length - copied )
+        )
+    except ( EnvironmentError, ValueError ):
+        pass
+
+    # chunked copy using the source file's position
+    if lock is None:
+        lock = threading.Lock()
+    while copied < length:
+        with lock:
+            source_handle.seek( ( start + copied ), os.SEEK_SET )
+            data = source_handle.read( min( copy_chunk, ( length - copied ) ) )
+        if len( data ) == 0:
+            break
+        target_handle.write( data )
+        copied += len( data )
+    return copied
+
+
+#=============================================================================
+def _cpmap( target_handle, source, start, length ):
+    """
+    Copy a range of bytes from a memory map of the source file.
+    """
+    end = min( ( start + length ), os.fstat( source ).st_size )
+    if end <= start:
+        return 0
+    base = start - ( start % mmap.ALLOCATIONGRANULARITY )
+    view = mmap.mmap(
+        source, ( end - base ), access = mmap.ACCESS_READ, offset = base
+    )
+    try:
+        for offset in range( ( start - base ), ( end - base ), copy_chunk ):
+            target_handle.write(
+                view[ offset : min( ( offset + copy_chunk ), ( end - base ) ) ]
+            )
+    finally:
+        view.close()
+    return end - start
+
+
+#=============================================================================
+def getblock( block ):
+    if block.find( ',' ) != -1:
+        ( start, stop ) = block.split( ',', 1 )
+        start  = getoffset( start )
+        length = getoffset( stop ) - start
+
+    else:
+        ( start, length ) = block.split( ':', 1 )
+        start  = getoffset( start )
+        length = getoffset( length )
+
+    return ( start, length )
 
 
 #=============================================================================
@@ -65,30 +229,123 @@ def getoffset( offset ):
     return getint( offset )
 
 
+#=============================================================================
+def _libc_function( name, *argtypes ):
+    """
+    Look up a C library function that returns ssize_t (None if missing).
+    """
+    function = getattr( _libc, name, None )
+    if function is not None:
+        function.argtypes = argtypes
+        function.restype  = ctypes.c_ssize_t
+    return function
+
+if _libc is not None:
+    _offset = ctypes.POINTER( ctypes.c_int64 )
+    _libc_copy_file_range = _libc_function(
+        'copy_file_range',
+        ctypes.c_int, _offset, ctypes.c_int, _offset, ctypes.c_size_t,
+        ctypes.c_uint
+    )
+    _libc_sendfile = _libc_function(
+        'sendfile64', ctypes.c_int, ctypes.c_int, _offset, ctypes.c_size_t
+    )
+else:
+    _libc_copy_file_range = None
+    _libc_sendfile        = None
+
+
+#=============================================================================
+def _libc_call( function, *args ):
+    """
+    Call a C library function, raising OSError when it fails.
+    """
+    result = function( *args )
+    if result == -1:
+        code = ctypes.get_errno()
+        raise OSError( code, os.strerror( code ) )
+    return result
+
+
+#=============================================================================
+def _copy_file_range( target, source, offset, count ):
+    if hasattr( os, 'copy_file_range' ):
+        return os.copy_file_range( source, target, count, offset )
+    if _libc_copy_file_range is None:
+        raise OSError( errno.ENOSYS, 'copy_file_range not available' )
+    return _libc_call(
+        _libc_copy_file_range,
+        source, ctypes.byref( ctypes.c_int64( offset ) ),
+        target, None,
+        count, 0
+    )
+
+
+#=============================================================================
+def _sendfile( target, source, offset, count ):
+    if hasattr( os, 'sendfile' ):
+        return os.sendfile( target, source, offset, count )
+    if _libc_sendfile is None:
+        raise OSError( errno.ENOSYS, 'sendfile not available' )
+    return _libc_call(
+        _libc_sendfile,
+        target, source, ctypes.byref( ctypes.c_int64( offset ) ), count
+    )
+
+
 #=============================================================================
 def main( argv ):
     """ Script execution entry point """
 
-    if len( argv ) < 4:
-        print 'usage: cpblock.py <input> <start>:<length> <output>'
-        print '       cpblock.py <input> <start>,<stop> <output>'
+    jobs = 1
+    if ( len( argv ) > 2 ) and ( argv[ 1 ] == '-j' ):
+        jobs = int( argv[ 2 ] )
+        argv = argv[ : 1 ] + argv[ 3 : ]
+
+    if ( len( argv ) < 4 ) or ( ( len( argv ) % 2 ) != 0 ):
+        print 'usage: cpblock.py [-j <jobs>] <input> <start>:<length> <output>'
+        print '       cpblock.py [-j <jobs>] <input> <start>,<stop> <output>'
         print '         note: offsets and lengths can use multiplication:'
         print '               cpblock.py in.dat 100:100*4 out.dat'
+        print '         note: many blocks can be copied at once:'
+        print '               cpblock.py in.dat 0:512 a.dat 512:512 b.dat'
+        print '         note: -j copies several blocks at the same time'
         return 0
 
-    copied = cpblock( argv[ 1 ], argv[ 2 ], argv[ 3 ] )
-    size   = os.path.getsize( argv[ 3 ] )
-
-    if copied != size:
-        print 'Error encountered copying data to %s (%d bytes off).' % (
-            argv[ 3 ],
-            ( size - copied )
-        )
+    blocks = zip( argv[ 2 : : 2 ], argv[ 3 : : 2 ] )
+    errors = []
+    try:
+        copied = cpblocks( argv[ 1 ], blocks, jobs, errors )
+    except EnvironmentError as error:
+        print 'Error encountered opening %s: %s' % ( argv[ 1 ], error )
         return 1
+    result = 0
+
+    for ( ( block, outfile ), count, error ) in zip( blocks, copied, errors ):
+        if error is not None:
+            print 'Error encountered copying data to %s: %s' % (
+                outfile,
+                error
+            )
+            result = 1
+            continue
+
+        size = os.path.getsize( outfile )
+        ( start, length ) = getblock( block )
+
+        if ( count != size ) or ( count != length ):
+            print 'Error encountered copying data to %s (%d bytes off).' % (
+                outfile,
+                ( length - size )
+            )
+            result = 1
 
-    print 'Copied %d bytes from %s to %s.' % ( copied, argv[ 1 ], argv[ 3 ] )
+        else:
+            print 'Copied %d bytes from %s to %s.' % (
+                count, argv[ 1 ], outfile
+            )
 
-    return 0
+    return result
 
 
 #=============================================================================
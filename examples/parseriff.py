@@ -3,30 +3,225 @@
 """
 Example RIFF (WAV contents) Data Parser
 
-Sample data is written to a CSV file for analysis.
-If matplotlib and numpy are available, signal plots (DFTs) are generated.
+The file is memory-mapped, and every chunk in the file is indexed.  Sample
+data is processed in blocks, so files of any size are handled in constant
+memory.  The magnitude of each frame (all channels, e.g. I/Q pairs) is
+written to a CSV file for analysis.
+If numpy is available, sample data is accessed through views of the mapped
+file, and a Welch-averaged spectrum of the magnitudes is computed.
+If matplotlib is also available, signal plots are generated.
 """
 
 
+import array
 import math
+import mmap
 import os
 import struct
-import wave
 
 try:
-    import matplotlib.pyplot as plot
     import numpy
-    import numpy.fft as fft
 except ImportError:
-    numeric_packages = False
-else:
-    numeric_packages = True
+    numpy = None
+
+try:
+    import matplotlib.pyplot as plot
+except ImportError:
+    plot = None
+
+
+# number of frames to process at a time
+_block_frames = 65536
+
+# number of magnitude samples in each spectrum segment
+_segment_size = 1024
+
+
+#=============================================================================
+class riff( object ):
+    """
+    Memory-mapped RIFF file with an index of its chunks.
+    """
+
+    #=========================================================================
+    _dtypes = {
+        ( 1, 8 )  : 'u1',
+        ( 1, 16 ) : '<i2',
+        ( 1, 32 ) : '<i4',
+        ( 3, 32 ) : '<f4',
+        ( 3, 64 ) : '<f8'
+    }
+
+    _array_codes = { 8 : 'B', 16 : 'h', 32 : 'i' }
+
+    #=========================================================================
+    def __init__( self, filename ):
+        """
+        Opens and indexes a RIFF file.
+        @param filename     Path to the RIFF file
+        """
+
+        self._handle = open( filename, 'rb' )
+        self._map    = mmap.mmap(
+            self._handle.fileno(), 0, access = mmap.ACCESS_READ
+        )
+
+        # check the RIFF header
+        ( magic, size, self.form ) = struct.unpack_from( '<4sI4s', self._map )
+        if magic != 'RIFF':
+            raise ValueError( 'Not a RIFF file: %s' % filename )
+
+        # index each chunk: ( id, data offset, data size )
+        self.chunks = []
+        offset      = 12
+        end         = min( len( self._map ), ( size + 8 ) )
+        while ( offset + 8 ) <= end:
+            ( cid, csize ) = struct.unpack_from( '<4sI', self._map, offset )
+            self.chunks.append( ( cid, ( offset + 8 ), csize ) )
+            offset += 8 + csize + ( csize & 1 )
+
+        # parse the format chunk
+        offset = self.find( 'fmt ' )[ 0 ]
+        fmt    = struct.unpack_from( '<HHIIHH', self._map, offset )
+        ( self.format, self.channels, self.rate ) = fmt[ : 3 ]
+        ( self.block_align, self.bits ) = fmt[ 4 : ]
+
+        # extensible formats store the actual format in a sub-format GUID
+        if self.format == 0xFFFE:
+            self.format = struct.unpack_from(
+                '<H', self._map, ( offset + 24 )
+            )[ 0 ]
+
+        # locate the sample data (truncated files are mapped as-is)
+        ( offset, size ) = self.find( 'data' )
+        self.data_offset = offset
+        self.frames      = min( size, len( self._map ) - offset ) \
+            // self.block_align
+
+    #=========================================================================
+    def close( self ):
+        """
+        Closes the file.
+        """
+        self._map.close()
+        self._handle.close()
+
+    #=========================================================================
+    def find( self, cid ):
+        """
+        Finds the first chunk with the given ID.
+        @param cid          Four-character chunk ID
+        @return             Tuple of the chunk data offset and size
+        """
+        for chunk in self.chunks:
+            if chunk[ 0 ] == cid:
+                return chunk[ 1 : ]
+        raise KeyError( 'Missing %s chunk.' % cid )
+
+    #=========================================================================
+    def get_frames( self, start = 0, count = None ):
+        """
+        Accesses a range of frames.  With numpy, this is a view of the mapped
+        file (frames by channels) that does not copy the sample data.
+        Without numpy, this is an array of interleaved channel samples.
+        @param start        Index of the first frame
+        @param count        Number of frames (default: all remaining frames)
+        @return             Sample data for the frames
+        """
+        if count is None:
+            count = self.frames - start
+        count  = max( 0, min( count, self.frames - start ) )
+        offset = self.data_offset + ( start * self.block_align )
+        if numpy is not None:
+            return numpy.frombuffer(
+                self._map,
+                self._dtypes[ ( self.format, self.bits ) ],
+                count * self.channels,
+                offset
+            ).reshape( count, self.channels )
+        samples = array.array( self._array_codes[ self.bits ] )
+        samples.fromstring(
+            self._map[ offset : offset + ( count * self.block_align ) ]
+        )
+        return samples
+
+    #=========================================================================
+    def iter_blocks( self, start = 0, count = None, size = _block_frames ):
+        """
+        Iterates over a range of frames in blocks.
+        @param start        Index of the first frame
+        @param count        Number of frames (default: all remaining frames)
+        @param size         Number of frames in each block
+        @return             Iterator of frame blocks (see get_frames())
+        """
+        if count is None:
+            count = self.frames - start
+        end = min( self.frames, start + count )
+        for index in xrange( start, end, size ):
+            yield self.get_frames( index, min( size, end - index ) )
+
+
+#=============================================================================
+def magnitudes( frames, channels ):
+    """
+    Computes the magnitude of each frame across all of its channels.
+    @param frames       Block of frames (see riff.get_frames())
+    @param channels     Number of channels in each frame
+    @return             Magnitudes (numpy array, or list without numpy)
+    """
+    if numpy is not None:
+        values = frames.astype( numpy.float64 )
+        return numpy.sqrt( numpy.einsum( 'ij,ij->i', values, values ) )
+    return [
+        math.sqrt( sum( v * v for v in frames[ i : ( i + channels ) ] ) )
+        for i in xrange( 0, len( frames ), channels )
+    ]
 
 
 #=============================================================================
-def frame2mag( frame ):
-    ( i, q ) = struct.unpack( '<BB', frame )
-    return math.sqrt( ( i ** 2 ) + ( q ** 2 ) )
+class welch( object ):
+    """
+    Welch-averaged power spectrum accumulated one block at a time.
+    Segments are Hann-windowed, and overlap by half a segment (including
+    segments that span blocks).
+    """
+
+    #=========================================================================
+    def __init__( self, size = _segment_size ):
+        self.size     = size
+        self.step     = size // 2
+        self.window   = numpy.hanning( size )
+        self.total    = numpy.zeros( ( size // 2 ) + 1 )
+        self.segments = 0
+        self._tail    = numpy.zeros( 0 )
+
+    #=========================================================================
+    def put( self, samples ):
+        """
+        Adds a block of samples to the spectrum.
+        """
+        samples = numpy.concatenate( ( self._tail, samples ) )
+        count   = 0
+        if len( samples ) >= self.size:
+            count = ( ( len( samples ) - self.size ) // self.step ) + 1
+            segments = numpy.lib.stride_tricks.as_strided(
+                samples,
+                shape   = ( count, self.size ),
+                strides = ( samples.strides[ 0 ] * self.step,
+                    samples.strides[ 0 ] )
+            )
+            spectra = numpy.fft.rfft( segments * self.window, axis = 1 )
+            self.total    += numpy.sum( numpy.abs( spectra ) ** 2, axis = 0 )
+            self.segments += count
+        self._tail = samples[ ( count * self.step ) : ].copy()
+
+    #=========================================================================
+    def get_db( self ):
+        """
+        Returns the average power in each frequency bin (dB).
+        """
+        power = self.total / max( 1, self.segments )
+        return 10 * numpy.log10( numpy.maximum( power, 1e-20 ) )
 
 
 #=============================================================================
@@ -38,57 +233,55 @@ def main( argv ):
         print 'You must specify at least an input file.'
         return 0
 
-    # start and length
+    # start and length (default is the entire file)
     start = 0
-    length = 1024
+    length = None
     if len( argv ) > 2:
         start = int( argv[ 2 ] )
     if len( argv ) > 3:
         length = int( argv[ 3 ] )
 
-    # open file using wave module
-    wfile = wave.open( argv[ 1 ], 'rb' )
+    # open and index the file
+    rfile = riff( argv[ 1 ] )
 
     # print file info
     print 'Channels: %d\nSample width: %d\nFrame rate: %d\nFrames: %d' % (
-        wfile.getnchannels(),
-        wfile.getsampwidth(),
-        wfile.getframerate(),
-        wfile.getnframes()
+        rfile.channels,
+        ( rfile.bits // 8 ),
+        rfile.rate,
+        rfile.frames
     )
+    for chunk in rfile.chunks:
+        print 'Chunk %r: offset %d, size %d' % chunk
 
-    # check for starting offset
-    if start > 0:
-        junk = wfile.readframes( start )
-
-    # read frames
-    frames = wfile.readframes( length )
-    samples = []
-    for i in range( length ):
-        index = i * 2
-        samples.append( frame2mag( frames[ index : ( index + 2 ) ] ) )
+    # process the samples in blocks, and write magnitudes in bulk
+    oname = os.path.splitext( argv[ 1 ] )[ 0 ] + '.csv'
+    ofile = open( oname, 'wb' )
+    spectrum = welch() if numpy is not None else None
+    first = None
+    for frames in rfile.iter_blocks( start, length ):
+        mags = magnitudes( frames, rfile.channels )
+        if spectrum is not None:
+            spectrum.put( mags )
+            mags = mags.astype( numpy.int64 ).tolist()
+        else:
+            mags = [ int( mag ) for mag in mags ]
+        if first is None:
+            first = mags[ : _segment_size ]
+        ofile.write( ''.join( '%d\n' % mag for mag in mags ) )
+    ofile.close()
 
-    # close wave file
-    wfile.close()
+    # close RIFF file
+    rfile.close()
 
     # plot
-    if numeric_packages == True:
-        fft_data = fft.fft( samples[ : 1024 ] )
-        mags = numpy.absolute( fft_data )
-        mags_db = [ 20 * numpy.log10( mag ) for mag in mags ]
+    if ( spectrum is not None ) and ( plot is not None ):
         plot.figure( 1 )
-        plot.plot( samples )
+        plot.plot( first )
         plot.figure( 2 )
-        plot.plot( mags_db )
+        plot.plot( spectrum.get_db() )
         plot.show()
 
-    # output
-    oname = argv[ 1 ].replace( '.wav', '.csv' )
-    ofile = open( oname, 'wb' )
-    for sample in samples:
-        ofile.write( '%d\n' % sample )
-    ofile.close()
-
     # Return success.
     return 0
 
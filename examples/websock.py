@@ -1,8 +1,6 @@
 #!/usr/bin/env python
 
 # ZIH - TODO:
-# - handle control messages appropriately
-# - implement interstitial control message handling
 # - validate initial request against the RFC requirements
 # - implement timeouts for clients that don't send pings
 # - implement thread limits, and flood protection
@@ -26,15 +24,30 @@ See http://tools.ietf.org/html/rfc6455
 
 
 import base64
+import binascii
+import collections
+import errno
 import hashlib
+import itertools
+import select
 import socket
 import struct
 import threading
+import zlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 __version__ = '0.0.0'
 
 
+# number of payload bytes to unmask at a time (must be a multiple of 4)
+_unmask_chunk = 65536
+
+
 #=============================================================================
 def load_fields( obj, fields, data ):
     """
@@ -71,6 +84,51 @@ def unload_fields( obj, fields ):
     return data
 
 
+#=============================================================================
+def unmask( data, mask_key ):
+    """
+    Apply (or remove) a WebSocket masking key to a payload.
+    The payload is XORed in bulk: as 32-bit words using numpy when it is
+    available, or as large integers otherwise.  Large payloads are processed
+    in chunks to limit temporary memory.
+    @param data         Payload string (or buffer)
+    @param mask_key     Four-byte masking key (string or sequence of ints)
+    @return             Unmasked payload string
+    """
+
+    # normalize the key to a string
+    if type( mask_key ) is not str:
+        mask_key = struct.pack( '4B', *mask_key )
+
+    # unmask each chunk as 32-bit words with numpy, then the remaining bytes
+    if numpy is not None:
+        chunks = []
+        key    = numpy.frombuffer( mask_key, numpy.uint32 )[ 0 ]
+        end    = len( data ) - ( len( data ) % 4 )
+        for offset in xrange( 0, end, _unmask_chunk ):
+            words = min( _unmask_chunk, ( end - offset ) ) // 4
+            chunks.append( (
+                numpy.frombuffer( data, numpy.uint32, words, offset ) ^ key
+            ).tobytes() )
+        tail = numpy.frombuffer( data, numpy.uint8, offset = end ) \
+            ^ numpy.frombuffer( mask_key, numpy.uint8, len( data ) % 4 )
+        chunks.append( tail.tobytes() )
+        return ''.join( chunks )
+
+    # unmask each chunk as one large integer
+    chunks = []
+    key    = mask_key * ( _unmask_chunk // 4 )
+    for offset in xrange( 0, len( data ), _unmask_chunk ):
+        chunk  = data[ offset : ( offset + _unmask_chunk ) ]
+        length = len( chunk )
+        value  = int( binascii.hexlify( chunk ), 16 ) \
+            ^ int( binascii.hexlify( key[ : length ] ), 16 )
+        chunks.append(
+            binascii.unhexlify( '%0*x' % ( ( length * 2 ), value ) )
+        )
+    return ''.join( chunks )
+
+
 #=============================================================================
 class _rfc6455_Frame( object ):
 
@@ -91,6 +149,7 @@ class _rfc6455_Frame( object ):
     _hdr = [
         {
             'final'   : ( 0x80, 7 ),
+            'rsv1'    : ( 0x40, 6 ),
             'control' : ( 0x08, 3 ),
             'opcode'  : ( 0x0F, 0 )
         },
@@ -109,7 +168,7 @@ class _rfc6455_Frame( object ):
 
     #=========================================================================
     def __init__( self, data = None ):
-        self._buffer   = ''
+        self._buffer   = bytearray()
         self._hfmt     = ''
         self._hlen     = 0
         self._offset   = 2
@@ -122,16 +181,40 @@ class _rfc6455_Frame( object ):
         self.mask      = 0
         self.mask_key  = None
         self.opcode    = 0
+        self.rsv1      = 0
         if data is not None:
             self.put( data )
 
     #=========================================================================
     @classmethod
-    def get_frame_data( cls, payload, binary = False ):
+    def get_close_data( cls, code = 1000 ):
+        """
+        Get the frame data for a close frame.
+        @param code     Close status code
+        @return         Frame data suitable for sending over a socket
+        """
+        return cls.get_frame_data(
+            struct.pack( '!H', code ),
+            opcode = cls.OP_CLOSE
+        )
+
+    #=========================================================================
+    @classmethod
+    def get_frame_data(
+        cls,
+        payload,
+        binary     = False,
+        compressed = False,
+        opcode     = None
+    ):
         """
         Get the frame data for a given payload.
         @param payload  The data to transport in the frame
         @param binary   Set to indicate frame is transporting binary data
+        @param compressed
+                        Set to indicate the payload is compressed
+                        (permessage-deflate, sets the RSV1 bit)
+        @param opcode   Frame opcode (default: text or binary data)
         @return         Frame data suitable for sending over a socket
         """
 
@@ -140,12 +223,12 @@ class _rfc6455_Frame( object ):
 
         # look for frames that need more than 16 bits to represent the length
         if length > 65535:
-            hfmt = 'BB' + cls._nhdrs[ 0 ][ 2 ]
+            hfmt = '!BB' + cls._nhdrs[ 0 ][ 2 ][ 1 : ]
             rlen = 127
 
         # look for frames that need more than 7 bits to represent the length
         elif length > 125:
-            hfmt = 'BB' + cls._nhdrs[ 0 ][ 1 ]
+            hfmt = '!BB' + cls._nhdrs[ 0 ][ 1 ][ 1 : ]
             rlen = 126
 
         # small/normal frame length
@@ -154,10 +237,13 @@ class _rfc6455_Frame( object ):
             rlen = length
 
         # determine opcode for type of data frame
-        opcode = cls.OP_BINARY if binary == True else cls.OP_TEXT
+        if opcode is None:
+            opcode = cls.OP_BINARY if binary == True else cls.OP_TEXT
 
         # set up the basic header information (final, opcode, length)
         fields = [ ( 0x80 | opcode ), rlen ]
+        if compressed == True:
+            fields[ 0 ] |= 0x40
 
         # long frame needs an additional length field
         if rlen > 125:
@@ -172,18 +258,19 @@ class _rfc6455_Frame( object ):
 
     #=========================================================================
     def get_payload( self ):
+        end = self._offset + self.length
         if self.mask == 1:
             if self._unmasked is None:
-                self._unmasked = ''.join(
-                    chr(
-                        ord( self._buffer[ i + self._offset ] )
-                        ^
-                        self.mask_key[ i % 4 ]
-                    )
-                    for i in range( self.length )
+                self._unmasked = unmask(
+                    memoryview( self._buffer )[ self._offset : end ],
+                    self.mask_key
                 )
             return self._unmasked
-        return self._buffer[ self._offset : ]
+        return bytes( self._buffer[ self._offset : end ] )
+
+    #=========================================================================
+    def get_size( self ):
+        return len( self._buffer )
 
     #=========================================================================
     def is_complete( self ):
@@ -203,23 +290,28 @@ class _rfc6455_Frame( object ):
 
     #=========================================================================
     def put( self, data ):
+        """
+        Add received data to the frame.  Only the data belonging to this frame
+        is consumed.  Any remaining data belongs to the next frame.
+        @param data         Received data (string, bytearray, or memoryview)
+        @return             Number of bytes consumed by the frame
+        """
 
-        # append data to internal buffer string
-        self._buffer += data
-        length = len( self._buffer )
+        consumed = 0
 
         # see if the frame is in the initial state
         if self._state == self._state_init:
 
-            # skip everything else if we haven't received a second byte yet
-            if length < 2:
-                return
+            # collect the first two header bytes
+            consumed += self._take( data, consumed, 2 )
+            if len( self._buffer ) < 2:
+                return consumed
 
             # load the core header data into the object
             load_fields(
                 self,
                 self._hdr,
-                struct.unpack( 'BB', self._buffer[ : 2 ] )
+                struct.unpack_from( 'BB', self._buffer )
             )
 
             # check for additional headers with a large payload length
@@ -242,43 +334,269 @@ class _rfc6455_Frame( object ):
         # see if the headers need additional parsing
         if self._state == self._state_headers:
 
-            # do we have enough data to finish header parsing?
-            if length >= self._offset:
+            # collect the rest of the headers
+            consumed += self._take( data, consumed, self._offset )
+            if len( self._buffer ) < self._offset:
+                return consumed
 
-                # parse additional header data (if any)
-                hdat = struct.unpack(
-                    self._hfmt,
-                    self._buffer[ 2 : self._offset ]
-                )
+            # parse additional header data (if any)
+            hdat = struct.unpack_from( self._hfmt, self._buffer, 2 )
 
-                # see if we should update payload length
-                if self.length > 125:
-                    self.length = hdat[ 0 ]
+            # see if we should update payload length
+            if self.length > 125:
+                self.length = hdat[ 0 ]
 
-                # see if we need a masking key
-                if self.mask == 1:
-                    self.mask_key = hdat[ -4 : ]
+            # see if we need a masking key
+            if self.mask == 1:
+                self.mask_key = hdat[ -4 : ]
 
-                # from here on, we are only capturing payload
-                self._state = self._state_payload
+            # from here on, we are only capturing payload
+            self._state = self._state_payload
 
         # see if we still need data for the payload
         if self._state == self._state_payload:
 
+            # collect the payload
+            end = self._offset + self.length
+            consumed += self._take( data, consumed, end )
+
             # see if we have captured enough data for the payload
-            if length >= ( 2 + self._hlen + self.length ):
+            if len( self._buffer ) >= end:
 
                 # all set
                 self._state = self._state_complete
 
+        return consumed
+
+    #=========================================================================
+    def _take( self, data, position, size ):
+        """
+        Append data to the frame's buffer until the buffer reaches a size.
+        @return             Number of bytes appended
+        """
+        count = min( size - len( self._buffer ), len( data ) - position )
+        if count > 0:
+            self._buffer += data[ position : ( position + count ) ]
+            return count
+        return 0
+
+
+#=============================================================================
+class _rfc6455_Error( ValueError ):
+    """
+    Received data that fails the connection.  The close status code sent to
+    the client is given by the error.
+    """
+
+    #=========================================================================
+    def __init__( self, message, code ):
+        """
+        @param message      Description of the error
+        @param code         Close status code (e.g. 1002, 1007, 1009)
+        """
+        ValueError.__init__( self, message )
+        self.code = code
+
+
+#=============================================================================
+class _rfc6455_Deflate( object ):
+    """
+    Per-connection permessage-deflate compression (RFC 7692).  Without
+    context takeover, the compression context is reset for every message,
+    which saves memory at the cost of the compression ratio.
+    """
+
+    #=========================================================================
+    # every compressed message ends with an empty stored block
+    _tail = '\x00\x00\xff\xff'
+
+    #=========================================================================
+    def __init__(
+        self,
+        server_takeover = True,
+        client_takeover = True,
+        server_bits     = 15,
+        client_bits     = 15,
+        level           = 6,
+        threshold       = 128
+    ):
+        """
+        @param server_takeover
+                            Keep the compression context between messages
+        @param client_takeover
+                            Let the client keep its compression context
+                            between messages
+        @param server_bits  Compression window size (9 to 15 bits)
+        @param client_bits  Requested client window size (9 to 15 bits)
+        @param level        Compression level (zlib)
+        @param threshold    Smallest payload that is compressed
+        """
+        self.client_bits     = client_bits
+        self.client_takeover = client_takeover
+        self.level           = level
+        self.server_bits     = server_bits
+        self.server_takeover = server_takeover
+        self.threshold       = threshold
+        self._compressor     = None
+        self._decompressor   = None
+
+    #=========================================================================
+    def compress( self, payload ):
+        """
+        Compress a message payload.
+        @param payload      Message payload
+        @return             Compressed message payload
+        """
+        if self._compressor is None:
+            self._compressor = zlib.compressobj(
+                self.level,
+                zlib.DEFLATED,
+                -self.server_bits
+            )
+        data = self._compressor.compress( payload ) \
+            + self._compressor.flush( zlib.Z_SYNC_FLUSH )
+        if self.server_takeover == False:
+            self._compressor = None
+        return data[ : -4 ]
+
+    #=========================================================================
+    def decompress( self, data, limit = 0 ):
+        """
+        Decompress a message payload.
+        @param data         Compressed message payload
+        @param limit        Maximum size of the message payload (0 for no
+                            limit)
+        @return             Message payload
+        @throws Error       If the payload is invalid (1007), or inflates
+                            beyond the limit (1009)
+        """
+        if self._decompressor is None:
+            self._decompressor = zlib.decompressobj( -15 )
+
+        # one byte of extra room lets the decompressor consume the empty
+        # block at the end of a payload that is exactly at the limit
+        try:
+            payload = self._decompressor.decompress(
+                data + self._tail,
+                ( limit + 1 ) if limit > 0 else 0
+            )
+        except zlib.error:
+            self._decompressor = None
+            raise _rfc6455_Error( 'Invalid compressed payload.', 1007 )
+        if ( limit > 0 ) and ( ( len( payload ) > limit ) \
+            or ( len( self._decompressor.unconsumed_tail ) > 0 ) ):
+            self._decompressor = None
+            raise _rfc6455_Error(
+                'Message exceeds the decompression limit.', 1009
+            )
+        if self.client_takeover == False:
+            self._decompressor = None
+        return payload
+
+    #=========================================================================
+    @classmethod
+    def negotiate( cls, offers, options ):
+        """
+        Select the first acceptable permessage-deflate offer from a client.
+        @param offers       Value of the Sec-WebSocket-Extensions header
+        @param options      Server options (see __init__())
+        @return             Tuple of the compression context, and the value
+                            of the response's Sec-WebSocket-Extensions
+                            header ( None, None ) if no offer is acceptable
+        """
+
+        for offer in offers.split( ',' ):
+            params = [ param.strip() for param in offer.split( ';' ) ]
+            if params[ 0 ] != 'permessage-deflate':
+                continue
+
+            # parse the offer's parameters
+            values = {}
+            for param in params[ 1 : ]:
+                ( name, value ) = ( param.split( '=', 1 ) + [ '' ] )[ : 2 ]
+                values[ name.strip() ] = value.strip().strip( '"' )
+
+            # reject offers with unknown or invalid parameters
+            names = set( [
+                'server_no_context_takeover', 'client_no_context_takeover',
+                'server_max_window_bits', 'client_max_window_bits'
+            ] )
+            if len( set( values ) - names ) > 0:
+                continue
+            try:
+                server_bits = int( values.get( 'server_max_window_bits', 15 ) )
+                client_bits = int( values.get( 'client_max_window_bits', 0 )
+                    or 15 )
+            except ValueError:
+                continue
+            # (zlib can not produce streams with a window below 9 bits)
+            if not ( ( 9 <= server_bits <= 15 ) \
+                and ( 8 <= client_bits <= 15 ) ):
+                continue
+
+            # apply the client's limits to the server's options
+            deflate = cls( **options )
+            if 'server_no_context_takeover' in values:
+                deflate.server_takeover = False
+            deflate.server_bits = min( deflate.server_bits, server_bits )
+            if 'client_max_window_bits' not in values:
+                deflate.client_bits = 15
+            deflate.client_bits = max(
+                min( deflate.client_bits, client_bits ),
+                8
+            )
+
+            # build the response
+            response = [ 'permessage-deflate' ]
+            if deflate.server_takeover == False:
+                response.append( 'server_no_context_takeover' )
+            if deflate.client_takeover == False:
+                response.append( 'client_no_context_takeover' )
+            if 'server_max_window_bits' in values:
+                response.append(
+                    'server_max_window_bits=%d' % deflate.server_bits
+                )
+            if deflate.client_bits < 15:
+                response.append(
+                    'client_max_window_bits=%d' % deflate.client_bits
+                )
+            return ( deflate, '; '.join( response ) )
+
+        return ( None, None )
+
 
 #=============================================================================
 class _rfc6455_Message( object ):
 
     #=========================================================================
-    def __init__( self ):
-        self._frame  = _rfc6455_Frame()
-        self._frames = []
+    def __init__( self, deflate = None ):
+        self.size     = 0
+        self._deflate = deflate
+        self._frame   = _rfc6455_Frame()
+        self._frames  = []
+        self._payload = None
+
+    #=========================================================================
+    def add_frame( self, frame, limit = 0 ):
+        """
+        Add a complete frame to the message.
+        @param frame        The next frame of the message
+        @param limit        Maximum size of a decompressed payload (0 for no
+                            limit)
+        @throws Error       If the payload can not be decompressed within the
+                            limit
+        """
+        self._frames.append( frame )
+        self.size += frame.get_size()
+
+        # compressed messages are decompressed as soon as they arrive, since
+        # the compression context may span messages
+        if ( self.is_complete() == True ) and ( self._deflate is not None ) \
+            and ( self._frames[ 0 ].rsv1 == 1 ):
+            self._payload = self._deflate.decompress(
+                ''.join( f.get_payload() for f in self._frames ),
+                limit
+            )
 
     #=========================================================================
     def is_complete( self ):
@@ -296,6 +614,8 @@ class _rfc6455_Message( object ):
 
     #=========================================================================
     def get_payload( self ):
+        if self._payload is not None:
+            return self._payload
         return ''.join( f.get_payload() for f in self._frames )
 
     #=========================================================================
@@ -307,39 +627,172 @@ class _rfc6455_Message( object ):
 
     #=========================================================================
     def put( self, data ):
-        self._frame.put( data )
-        if self._frame.is_complete() == True:
-            self._frames.append( self._frame )
-            self._frame = _rfc6455_Frame()
+        """
+        Add received data to the message.
+        @param data         Received data (string, bytearray, or memoryview)
+        @return             Number of bytes consumed by the message
+        """
+        consumed = 0
+        while ( consumed < len( data ) ) and ( self.is_complete() == False ):
+            consumed += self._frame.put( data[ consumed : ] )
+            if self._frame.is_complete() == True:
+                self.add_frame( self._frame )
+                self._frame = _rfc6455_Frame()
+        return consumed
 
 
 #=============================================================================
 class _rfc6455_Stream( object ):
+    """
+    Splits received data into messages.  Control messages (ping, pong,
+    close) are queued separately as soon as they arrive, even between the
+    fragments of a data message, and are returned before data messages.
+    The number of messages and bytes the stream buffers is limited: callers
+    should stop receiving while the stream is full.
+    """
+
+    #=========================================================================
+    def __init__(
+        self,
+        size         = 65536,
+        deflate      = None,
+        max_bytes    = 16777216,
+        max_messages = 1024
+    ):
+        """
+        @param size         Size of the stream's own receive buffer
+        @param deflate      Negotiated compression context (rfc6455.Deflate)
+        @param max_bytes    Maximum number of received bytes to buffer
+                            (including a partially received message)
+        @param max_messages Maximum number of complete messages to buffer
+        """
+        self.deflate      = deflate
+        self.max_bytes    = max_bytes
+        self.max_messages = max_messages
+        self._buffered    = 0
+        self._control     = collections.deque()
+        self._fifo        = collections.deque()
+        self._frame       = _rfc6455_Frame()
+        self._message     = _rfc6455_Message( deflate )
+        self._pending     = 0
+        self._size        = size
+        self._view        = None
 
     #=========================================================================
-    def __init__( self ):
-        self._fifo    = []
-        self._message = _rfc6455_Message()
+    def encode( self, payload, binary = False ):
+        """
+        Get the frame data for a message sent on this stream.  Payloads are
+        compressed when permessage-deflate was negotiated, and the payload
+        is at least as long as the compression threshold.
+        @param payload      Message payload
+        @param binary       Set to send a binary message
+        @return             Frame data suitable for sending over a socket
+        """
+        if ( self.deflate is not None ) \
+            and ( len( payload ) >= self.deflate.threshold ):
+            return _rfc6455_Frame.get_frame_data(
+                self.deflate.compress( payload ),
+                binary,
+                True
+            )
+        return _rfc6455_Frame.get_frame_data( payload, binary )
 
     #=========================================================================
     def get_message( self ):
-        try:
-            return self._fifo.pop( 0 )
-        except IndexError:
+        if len( self._control ) > 0:
+            message = self._control.popleft()
+        elif len( self._fifo ) > 0:
+            message = self._fifo.popleft()
+        else:
             raise ValueError
+        self._buffered -= message.size
+        return message
+
+    #=========================================================================
+    def is_full( self ):
+        """
+        Check if the stream has reached its buffering limits.  A stream that
+        only holds part of a message is never full, so the rest of the
+        message can be received (or found to be too large).
+        """
+        return ( len( self._fifo ) >= self.max_messages ) \
+            or ( ( self._buffered >= self.max_bytes ) \
+                and ( self._buffered > self._pending ) )
 
     #=========================================================================
     def put( self, data ):
-        self._message.put( data )
-        # ZIH - this does not handle control messages that occur in the middle
-        #       of a fragmented data message
-        # -- consider handling frames directly at this level, and
-        #    detecting continue frames.  then, make message a subclass
-        #    of frame that can be extended by appending data from future
-        # frame objects
-        if self._message.is_complete() == True:
-            self._fifo.append( self._message )
-            self._message = _rfc6455_Message()
+        """
+        Add received data to the stream.  Data may contain any number of
+        frames (or parts of frames).
+        @param data         Received data (string, bytearray, or memoryview)
+        @throws Error       If a single message exceeds the buffer limit
+                            (compressed, or after it is decompressed), or
+                            the data violates the protocol
+        """
+        if not isinstance( data, memoryview ):
+            data = memoryview( data )
+        consumed = 0
+        while consumed < len( data ):
+            count = self._frame.put( data[ consumed : ] )
+            consumed       += count
+            self._buffered += count
+            self._pending  += count
+            if self._frame.is_complete() == False:
+                if self._pending > self.max_bytes:
+                    raise _rfc6455_Error(
+                        'Message exceeds the stream limit.', 1009
+                    )
+                continue
+            frame       = self._frame
+            self._frame = _rfc6455_Frame()
+
+            # RSV1 marks a compressed message, so it is only valid on the
+            # first frame of a data message, with permessage-deflate
+            if ( frame.rsv1 == 1 ) and ( ( self.deflate is None ) \
+                or ( frame.is_control() == True ) \
+                or ( frame.opcode == _rfc6455_Frame.OP_CONTINUATION ) ):
+                raise _rfc6455_Error( 'Unexpected RSV1 bit.', 1002 )
+
+            # control frames are never fragmented, so they are handled
+            # immediately, even in the middle of a fragmented data message
+            if frame.is_control() == True:
+                message = _rfc6455_Message()
+                message.add_frame( frame )
+                self._control.append( message )
+                self._pending -= message.size
+                continue
+
+            # compressed payloads may only inflate into the remaining room
+            self._message.add_frame(
+                frame,
+                max( 1, ( self.max_bytes - self._buffered ) )
+            )
+            if self._message.is_complete() == True:
+                self._fifo.append( self._message )
+                self._message = _rfc6455_Message( self.deflate )
+                self._pending = 0
+
+    #=========================================================================
+    def receive( self, connection, view = None ):
+        """
+        Receive data from a socket directly into a receive buffer, and add it
+        to the stream.
+        @param connection   Connected socket
+        @param view         Optional memoryview of a receive buffer to use
+                            (e.g. shared by many streams), otherwise the
+                            stream allocates its own
+        @return             Number of bytes received (0 if the socket closed)
+        """
+        if view is None:
+            if self._view is None:
+                self._view = memoryview( bytearray( self._size ) )
+            view = self._view
+        # never receive more than the stream has room to buffer
+        room  = min( len( view ), ( self.max_bytes - self._buffered ) )
+        count = connection.recv_into( view, max( 1, room ) )
+        if count > 0:
+            self.put( view[ : count ] )
+        return count
 
 
 #=============================================================================
@@ -358,11 +811,16 @@ Sec-WebSocket-Origin: %s
 Sec-WebSocket-Location: ws://%s
 Sec-WebSocket-Accept: %s
 Sec-WebSocket-Protocol: sample
-
+%s
 '''
 
+    # permessage-deflate options (see Deflate), or None to disable
+    deflate_options = {}
+
 
     #=========================================================================
+    Deflate = _rfc6455_Deflate
+    Error   = _rfc6455_Error
     Frame   = _rfc6455_Frame
     Message = _rfc6455_Message
     Stream  = _rfc6455_Stream
@@ -372,6 +830,24 @@ Sec-WebSocket-Protocol: sample
     @classmethod
     def handshake( cls, connection ):
         """
+        Perform the opening handshake on a blocking socket.
+        @param connection   Connected socket
+        @return             Stream for the connection's messages
+        """
+        ( response, deflate ) = cls.get_response( connection.recv( 1024 ) )
+        connection.send( response )
+        return cls.Stream( deflate = deflate )
+
+
+    #=========================================================================
+    @classmethod
+    def get_response( cls, request ):
+        """
+        Build the handshake response for a client's opening handshake.
+        @param request      The client's complete handshake request
+        @return             Tuple of the handshake response to send to the
+                            client, and the negotiated compression context
+                            (None without compression)
         """
 
 # typical HTTP request headers (rfc6455)
@@ -384,7 +860,6 @@ Sec-WebSocket-Protocol: sample
 # Sec-WebSocket-Protocol: chat, superchat
 # Sec-WebSocket-Version: 13
 
-        request  = connection.recv( 1024 )
         lines    = request.strip().splitlines()
         headers  = dict( h.split( ': ', 1 ) for h in lines if ': ' in h )
 
@@ -404,69 +879,623 @@ Sec-WebSocket-Protocol: sample
 #   optional Sec-WebSocket-Protocol:
 #   optional Sec-WebSocket-Extensions:
 
+        # negotiate permessage-deflate (rfc7692)
+        deflate    = None
+        extensions = ''
+        offers     = headers.get( 'Sec-WebSocket-Extensions' )
+        if ( offers is not None ) and ( cls.deflate_options is not None ):
+            ( deflate, accepted ) = cls.Deflate.negotiate(
+                offers,
+                cls.deflate_options
+            )
+            if deflate is not None:
+                extensions = 'Sec-WebSocket-Extensions: %s\n' % accepted
+
         key      = headers[ 'Sec-WebSocket-Key' ]
         response = cls._handshake % (
             headers[ 'Origin' ],
             headers[ 'Host' ] + lines[ 0 ].split()[ 1 ],
-            base64.b64encode( hashlib.sha1( key + cls.GUID ).digest() )
+            base64.b64encode( hashlib.sha1( key + cls.GUID ).digest() ),
+            extensions
         )
-        connection.send( response )
+        return ( response, deflate )
 
 
 #=============================================================================
 def handle( connection, address ):
 
     try:
-        rfc6455.handshake( connection )
+        stream = rfc6455.handshake( connection )
     except:
         connection.close()
         return
 
-    stream = rfc6455.Stream()
+    def reply( payload ):
+        connection.sendall( stream.encode( payload ) )
+
+    # start the socket handling loop (the connection is always closed when
+    # the loop ends, even when the client disconnects abruptly)
+    try:
+        while True:
+
+            # block until new data arrives from the client, and put it to
+            # stream (no data means the socket has closed)
+            try:
+                if stream.receive( connection ) == 0:
+                    break
+
+            # message is too big to buffer, or violates the protocol
+            except rfc6455.Error as error:
+                connection.sendall(
+                    rfc6455.Frame.get_close_data( error.code )
+                )
+                break
+
+            # handle each complete message in the input stream
+            if respond( stream, reply, connection.sendall ) == False:
+                break
+
+    # close our connection object
+    finally:
+        connection.close()
+
+
+#=============================================================================
+def respond( stream, reply, send ):
+    """
+    Handle each complete message in a stream.
+    @param stream       The connection's rfc6455.Stream
+    @param reply        Function that sends a text message to the client
+    @param send         Function that sends frame data to the client
+    @return             False if the client closed the connection
+    """
 
-    # start the socket handling loop
     while True:
+        try:
+            message = stream.get_message()
+        except ValueError:
+            return True
+
+        # get type of message
+        mtype = message.get_type()
+
+        # close control message (echo the status code to the client)
+        if mtype == rfc6455.Frame.OP_CLOSE:
+            send( rfc6455.Frame.get_frame_data(
+                message.get_payload()[ : 2 ],
+                opcode = rfc6455.Frame.OP_CLOSE
+            ) )
+            return False
 
-        # block until new data arrives from the client
-        data = connection.recv( 1024 )
+        # ping control message
+        elif mtype == rfc6455.Frame.OP_PING:
+            send( rfc6455.Frame.get_frame_data(
+                message.get_payload(),
+                opcode = rfc6455.Frame.OP_PONG
+            ) )
 
-        # data received from connection
-        if len( data ) > 0:
+        # handle text messages
+        elif mtype == rfc6455.Frame.OP_TEXT:
+            text = message.get_payload()
+            reply( text.upper() )
 
-            # put data to stream
-            stream.put( data )
 
-            # get the next message in the input stream
-            try:
-                message = stream.get_message()
-            except ValueError:
-                pass
+#=============================================================================
+class channel( object ):
+    """
+    Publish/subscribe broadcast to many event loop connections.  Each
+    message is encoded as a frame once, and the same frame data is queued
+    for every subscriber.  Subscribers that fall behind by more than a limit
+    are either dropped (disconnected), or coalesced (intermediate messages
+    are skipped, and the latest message is sent when they catch up).
+    Broadcast frames are not compressed, since permessage-deflate contexts
+    belong to each connection.
+    """
+
+    #=========================================================================
+    def __init__( self, limit = 1048576, policy = 'coalesce' ):
+        """
+        @param limit        Number of bytes a subscriber may have queued
+        @param policy       Handling of slow subscribers: 'drop' or
+                            'coalesce'
+        """
+        if policy not in ( 'drop', 'coalesce' ):
+            raise ValueError( 'Unknown slow subscriber policy: %s' % policy )
+        self.limit       = limit
+        self.policy      = policy
+        self.subscribers = set()
+
+    #=========================================================================
+    def publish( self, payload, binary = False ):
+        """
+        Broadcast a message to all subscribers.
+        @param payload      The message payload
+        @param binary       Set to send a binary message
+        @return             Number of subscribers that queued the message
+        """
+        return self.send( rfc6455.Frame.get_frame_data( payload, binary ) )
+
+    #=========================================================================
+    def send( self, data ):
+        """
+        Broadcast frame data to all subscribers.
+        @param data         Encoded frame data (see Frame.get_frame_data())
+        @return             Number of subscribers that queued the data
+        """
+        count = 0
+        for subscriber in list( self.subscribers ):
+
+            # once a subscriber has a coalesced message waiting, newer
+            # messages replace it until it is sent (keeping them in order)
+            if ( subscriber.latest is None ) and ( ( subscriber.queued == 0 ) \
+                or ( ( subscriber.queued + len( data ) ) <= self.limit ) ):
+                subscriber.send( data )
+                count += 1
+            elif self.policy == 'drop':
+                self.unsubscribe( subscriber )
+                subscriber.abort()
             else:
+                subscriber.latest = data
+        return count
 
-                # get type of message
-                mtype = message.get_type()
+    #=========================================================================
+    def subscribe( self, connection ):
+        """
+        Add a connection to the channel.
+        """
+        self.subscribers.add( connection )
 
-                # close control message
-                if mtype == rfc6455.Frame.OP_CLOSE:
-                    # ZIH - echo frame payload to client
-                    break
+    #=========================================================================
+    def unsubscribe( self, connection ):
+        """
+        Remove a connection from the channel.
+        """
+        self.subscribers.discard( connection )
+
+
+#=============================================================================
+class _connection( object ):
+    """
+    State of one client connection in the event loop server.
+    """
+
+    #=========================================================================
+    def __init__( self, sock, address, wake, channel = None ):
+        self.address = address
+        self.channel = channel
+        self.closing = False
+        self.latest  = None
+        self.queue   = collections.deque()
+        self.queued  = 0
+        self.request = ''
+        self.sock    = sock
+        self.fd      = sock.fileno()
+        self.stream  = None
+        self.offset  = 0
+        self.wake    = wake
+        self.mask    = 0
 
-                # ZIH - also look for OP_PING (send OP_PONG)
+    #=========================================================================
+    def abort( self ):
+        """
+        Discard queued data, and close the connection.
+        """
+        self.closing = True
+        self.latest  = None
+        self.queue.clear()
+        self.queued  = 0
+        self.offset  = 0
+        self.wake.add( self )
 
-                # handle text messages
-                elif mtype == rfc6455.Frame.OP_TEXT:
-                    text = message.get_payload()
-                    data = rfc6455.Frame.get_frame_data( text.upper() )
-                    connection.send( data )
+    #=========================================================================
+    def is_paused( self ):
+        """
+        Check if reading from the client should pause (the connection is
+        closing, its stream is full, or too much data is waiting to be sent
+        to the client).
+        """
+        return ( self.closing == True ) or ( self.queued >= _queue_limit ) \
+            or ( ( self.stream is not None ) and self.stream.is_full() )
 
-        # empty data from connection (socket has closed)
+    #=========================================================================
+    def reply( self, payload ):
+        """
+        Send a text message to the client (or broadcast it, when subscribed
+        to a channel).
+        """
+        if self.channel is not None:
+            self.channel.publish( payload )
         else:
+            self.send( self.stream.encode( payload ) )
+
+    #=========================================================================
+    def send( self, data ):
+        """
+        Queue data to send to the client.
+        """
+        self.queue.append( data )
+        self.queued += len( data )
+        self.wake.add( self )
+
+    #=========================================================================
+    def read( self, view ):
+        """
+        Read available data from the client.
+        @param view         Shared receive buffer
+        @return             False if the connection should be closed
+        """
+
+        # complete the opening handshake
+        if self.stream is None:
+            data = self.sock.recv( 1024 )
+            if len( data ) == 0:
+                return False
+            self.request += data
+            if ( '\r\n\r\n' not in self.request ) \
+                and ( '\n\n' not in self.request ):
+                return len( self.request ) < 8192
+            ( response, deflate ) = rfc6455.get_response( self.request )
+            self.send( response )
+            self.request = None
+            self.stream  = rfc6455.Stream( deflate = deflate )
+            if self.channel is not None:
+                self.channel.subscribe( self )
+            return True
+
+        # put new data into the stream, and handle complete messages
+        try:
+            if self.stream.receive( self.sock, view ) == 0:
+                return False
+        except rfc6455.Error as error:
+            self.send( rfc6455.Frame.get_close_data( error.code ) )
+            self.closing = True
+            return True
+        if respond( self.stream, self.reply, self.send ) == False:
+            self.closing = True
+        self.wake.add( self )
+        return True
+
+    #=========================================================================
+    def write( self ):
+        """
+        Send as much queued data as the socket will accept.  Several queued
+        frames are sent with each gathered write (where sendmsg is
+        available).
+        @return             True when the queue is empty
+        """
+        while True:
+
+            # queue the latest coalesced message once the queue drains
+            if len( self.queue ) == 0:
+                if self.latest is None:
+                    return True
+                self.queue.append( self.latest )
+                self.queued += len( self.latest )
+                self.latest  = None
+
+            head = memoryview( self.queue[ 0 ] )[ self.offset : ]
+            try:
+                if _sendmsg == True:
+                    count = self.sock.sendmsg(
+                        [ head ] + list(
+                            itertools.islice( self.queue, 1, _gather )
+                        )
+                    )
+                else:
+                    count = self.sock.send( head )
+            except socket.error as error:
+                if error.args[ 0 ] in _blocked:
+                    return False
+                raise
+
+            # remove everything that was sent from the queue
+            self.queued -= count
+            count       += self.offset
+            while ( len( self.queue ) > 0 ) \
+                and ( count >= len( self.queue[ 0 ] ) ):
+                count -= len( self.queue.popleft() )
+            self.offset = count
+
+
+#=============================================================================
+def wsloop( address, reuse_port = False, channel = None ):
+    """
+    Run a single-threaded event loop server (epoll, or poll where epoll is
+    not available).  Connections are non-blocking, and each connection has
+    its own queue of outgoing data.
+    @param address      Listen address
+    @param reuse_port   Set SO_REUSEPORT so several processes may listen on
+                        the same port
+    @param channel      Optional channel that every connection subscribes
+                        to (messages are broadcast instead of echoed)
+    @return             Exit code (0 = success)
+    """
+
+    # select the poller and its event flags
+    if hasattr( select, 'epoll' ):
+        poller = select.epoll()
+        ( rd, wr, er ) = ( select.EPOLLIN, select.EPOLLOUT,
+            select.EPOLLERR | select.EPOLLHUP )
+    else:
+        poller = select.poll()
+        ( rd, wr, er ) = ( select.POLLIN, select.POLLOUT,
+            select.POLLERR | select.POLLHUP )
+
+    # set up the listen socket
+    sock = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
+    sock.setsockopt( socket.SOL_SOCKET, socket.SO_REUSEADDR, 1 )
+    if reuse_port == True:
+        sock.setsockopt( socket.SOL_SOCKET, socket.SO_REUSEPORT, 1 )
+    sock.bind( address )
+    sock.listen( socket.SOMAXCONN )
+    sock.setblocking( 0 )
+    poller.register( sock.fileno(), rd )
+
+    # receive buffer shared by all connections
+    view = memoryview( bytearray( 65536 ) )
+
+    # connections by descriptor, and connections with data to send
+    connections = {}
+    wake        = set()
 
-            # shut down socket handling loop
+    def close( connection ):
+        if connection.channel is not None:
+            connection.channel.unsubscribe( connection )
+        wake.discard( connection )
+        poller.unregister( connection.fd )
+        del connections[ connection.fd ]
+        connection.sock.close()
+
+    while True:
+        try:
+            events = poller.poll()
+        except ( KeyboardInterrupt, SystemExit ):
             break
+        except ( IOError, OSError, select.error ) as error:
+            if error.args[ 0 ] == errno.EINTR:
+                continue
+            raise
+
+        for fd, event in events:
+
+            # accept all pending connections
+            if fd == sock.fileno():
+                while True:
+                    try:
+                        client, client_address = sock.accept()
+                    except socket.error as error:
+                        if error.args[ 0 ] in _blocked:
+                            break
+                        raise
+                    client.setblocking( 0 )
+                    connections[ client.fileno() ] = _connection(
+                        client,
+                        client_address,
+                        wake,
+                        channel
+                    )
+                    poller.register( client.fileno(), rd )
+                    connections[ client.fileno() ].mask = rd
+                continue
 
-    # close our connection object
-    connection.close()
+            connection = connections.get( fd )
+            if connection is None:
+                continue
+
+            # read from the client
+            try:
+                if event & ( rd | er ):
+                    if connection.read( view ) == False:
+                        close( connection )
+                        continue
+            except socket.error as error:
+                if error.args[ 0 ] not in _blocked:
+                    close( connection )
+                continue
+            except:
+                close( connection )
+                continue
+
+            # the socket can accept more data
+            if event & wr:
+                wake.add( connection )
+
+        # send queued data (only waiting to write when it blocks), and stop
+        # reading from connections that are backed up
+        while len( wake ) > 0:
+            connection = wake.pop()
+            try:
+                done = connection.write()
+            except:
+                close( connection )
+                continue
+            if ( done == True ) and ( connection.closing == True ):
+                close( connection )
+                continue
+            mask = 0 if connection.is_paused() == True else rd
+            if done == False:
+                mask |= wr
+            if mask != connection.mask:
+                poller.modify( connection.fd, mask )
+                connection.mask = mask
+
+    for connection in connections.values():
+        close( connection )
+    sock.close()
+    return 0
+
+
+#=============================================================================
+def wsprocesses( address, processes, channel = None ):
+    """
+    Run an event loop server in several processes that share a listen port
+    (requires SO_REUSEPORT).
+    @param address      Listen address
+    @param processes    Number of server processes
+    @param channel      Optional broadcast channel (each process broadcasts
+                        to its own connections)
+    @return             Exit code (0 = success)
+    """
+    import multiprocessing
+    workers = [
+        multiprocessing.Process(
+            target = wsloop,
+            args   = ( address, True, channel )
+        )
+        for i in range( processes )
+    ]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    try:
+        for worker in workers:
+            worker.join()
+    except ( KeyboardInterrupt, SystemExit ):
+        for worker in workers:
+            worker.terminate()
+    return 0
+
+
+# socket errors that mean an operation would block
+_blocked = ( errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR )
+
+# reading from a client pauses while this many bytes are queued to send to it
+_queue_limit = 4194304
+
+# gathered writes (sendmsg) send up to this many queued frames at a time
+_gather  = 64
+_sendmsg = hasattr( socket.socket, 'sendmsg' )
+
+
+#=============================================================================
+def benchmark( size = 4194304 ):
+    """
+    Measure payload unmasking throughput, and compare it to the original
+    byte-at-a-time implementation.
+    @param size         Payload size in bytes
+    @return             Dict of MB/s for each method
+    """
+    import os
+    import time
+
+    data     = os.urandom( size )
+    mask_key = tuple( bytearray( os.urandom( 4 ) ) )
+
+    # original per-byte generator
+    start  = time.time()
+    before = ''.join(
+        chr( ord( data[ i ] ) ^ mask_key[ i % 4 ] ) for i in range( size )
+    )
+    slow = time.time() - start
+
+    # bulk unmasking
+    start = time.time()
+    after = unmask( data, mask_key )
+    fast  = time.time() - start
+
+    if before != after:
+        raise ValueError( 'Unmasked payloads do not match.' )
+
+    megabytes = size / 1048576.0
+    return {
+        'before' : megabytes / max( slow, 1e-9 ),
+        'after'  : megabytes / max( fast, 1e-9 )
+    }
+
+
+#=============================================================================
+def _test_coalesce_order():
+    """
+    A coalesced message is never sent after a newer broadcast message.
+    """
+
+    # socket that accepts a limited number of bytes, then would block
+    class sink( object ):
+        def __init__( self ):
+            self.data  = ''
+            self.room  = 0
+        def fileno( self ):
+            return -1
+        def send( self, data ):
+            if self.room == 0:
+                raise socket.error( errno.EAGAIN, 'would block' )
+            data = data[ : self.room ].tobytes()
+            self.data += data
+            self.room -= len( data )
+            return len( data )
+        def sendmsg( self, buffers ):
+            return self.send( memoryview( ''.join(
+                memoryview( b ).tobytes() for b in buffers
+            ) ) )
+
+    frames = [
+        rfc6455.Frame.get_frame_data( c * 6 ) for c in ( 'A', 'B', 'C' )
+    ]
+    hub  = channel( limit = 10, policy = 'coalesce' )
+    sock = sink()
+    peer = _connection( sock, None, set(), hub )
+    hub.subscribe( peer )
+
+    # B is coalesced behind A, then room opens up before C is published
+    hub.publish( 'AAAAAA' )
+    hub.publish( 'BBBBBB' )
+    sock.room = 6
+    peer.write()
+    hub.publish( 'CCCCCC' )
+    sock.room = 1024
+    peer.write()
+
+    expected = frames[ 0 ] + frames[ 2 ]
+    if sock.data != expected:
+        return 'received %r, expected %r' % ( sock.data, expected )
+    return None
+
+
+#=============================================================================
+def _test_deflate_errors():
+    """
+    Compressed payloads fail with the right close status codes.
+    """
+
+    # a payload exactly at the limit is accepted, and one byte over is not
+    payload    = 'limit' * 100
+    compressor = zlib.compressobj( 6, zlib.DEFLATED, -15 )
+    data       = compressor.compress( payload ) \
+        + compressor.flush( zlib.Z_SYNC_FLUSH )
+    if rfc6455.Deflate().decompress( data[ : -4 ], 500 ) != payload:
+        return 'payload at the limit was not accepted'
+    tests = [
+        ( lambda : rfc6455.Deflate().decompress( data[ : -4 ], 499 ), 1009 ),
+        ( lambda : rfc6455.Deflate().decompress( '\xff\xff\xff' ), 1007 ),
+        ( lambda : rfc6455.Stream().put( '\xc1\x80\x00\x00\x00\x00' ), 1002 )
+    ]
+    for function, code in tests:
+        try:
+            function()
+        except rfc6455.Error as error:
+            if error.code != code:
+                return 'close code %d, expected %d' % ( error.code, code )
+        else:
+            return 'no error, expected close code %d' % code
+    return None
+
+
+#=============================================================================
+def _test():
+    """
+    Execute each of the script's self-tests (functions named "_test_*").
+    @return             True if every test passes
+    """
+    result = True
+    for name, function in sorted( globals().items() ):
+        if ( name[ : 6 ] == '_test_' ) and callable( function ):
+            error = function()
+            if error is None:
+                print 'PASSED %s' % name
+            else:
+                print 'FAILED %s: %s' % ( name, error )
+                result = False
+    return result
 
 
 #=============================================================================
@@ -508,8 +1537,30 @@ def main( argv ):
         '-p',
         '--port',
         default = 9999,
+        type    = int,
         help    = 'TCP listen port.',
     )
+    parser.add_argument(
+        '-m',
+        '--mode',
+        default = 'thread',
+        choices = ( 'thread', 'event' ),
+        help    = 'Server mode: a thread per connection, or an event loop.'
+    )
+    parser.add_argument(
+        '-n',
+        '--processes',
+        default = 1,
+        type    = int,
+        help    = 'Number of event loop processes (uses SO_REUSEPORT).'
+    )
+    parser.add_argument(
+        '-c',
+        '--broadcast',
+        default = False,
+        help    = 'Broadcast each message to every client (event mode).',
+        action  = 'store_true'
+    )
     parser.add_argument(
         '-v',
         '--version',
@@ -517,17 +1568,52 @@ def main( argv ):
         help    = 'Display script version.',
         action  = 'store_true'
     )
+    parser.add_argument(
+        '-b',
+        '--benchmark',
+        default = False,
+        help    = 'Measure payload unmasking throughput.',
+        action  = 'store_true'
+    )
+    parser.add_argument(
+        '-t',
+        '--test',
+        default = False,
+        help    = 'Execute script self-tests.',
+        action  = 'store_true'
+    )
 
     # parse the arguments
     args = parser.parse_args( argv[ 1 : ] )
 
+    # broadcast channels only work with event loop connections
+    if ( args.broadcast == True ) and ( args.mode != 'event' ):
+        parser.error( '--broadcast requires --mode event' )
+
     # check for version request
     if args.version == True:
         print 'Version', __version__
         return 0
 
+    # check for self-test request
+    if args.test == True:
+        return 0 if _test() == True else 1
+
+    # check for benchmark request
+    if args.benchmark == True:
+        result = benchmark()
+        print 'Unmasking before: %.2f MB/s' % result[ 'before' ]
+        print 'Unmasking after:  %.2f MB/s' % result[ 'after' ]
+        return 0
+
     # run the server until interrupted
-    exit_code = wsnet( ( '', args.port ) )
+    hub = channel() if args.broadcast == True else None
+    if args.mode == 'thread':
+        exit_code = wsnet( ( '', args.port ) )
+    elif args.processes > 1:
+        exit_code = wsprocesses( ( '', args.port ), args.processes, hub )
+    else:
+        exit_code = wsloop( ( '', args.port ), False, hub )
 
     # return success
     return exit_code
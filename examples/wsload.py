@@ -0,0 +1,476 @@
+#!/usr/bin/env python
+
+
+"""
+WebSocket Load Generator
+
+Opens many concurrent client connections to a local websock.py server, sends
+masked text messages of a configurable size and rate, and reports the
+message rate, throughput, and round-trip latency of the server's echo
+handler.
+
+Clients are spread across worker processes, and each worker drives its
+connections from a single poll loop.  Without a rate, each connection keeps
+a fixed number of messages in flight (a closed loop).  With a rate, each
+connection sends on a fixed schedule regardless of replies.
+
+Run against a server that is already listening:
+    ./wsload.py -p 9999 -c 100 -s 1024 -d 10
+
+Or start each websock.py server mode in turn, and compare them:
+    ./wsload.py --compare -c 100 -s 1024 -d 10
+"""
+
+
+import base64
+import collections
+import errno
+import os
+import select
+import socket
+import struct
+import time
+
+import websock
+
+
+__version__ = '0.0.0'
+
+
+#=============================================================================
+def connect( address ):
+    """
+    Connect to a WebSocket server, and complete the opening handshake.
+    @param address      Server address
+    @return             Tuple of the connected (non-blocking) socket, and a
+                        stream holding any data received after the handshake
+    """
+
+    sock = socket.create_connection( address )
+    sock.setsockopt( socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 )
+    sock.sendall(
+        'GET /load HTTP/1.1\r\n'
+        'Host: %s:%d\r\n'
+        'Upgrade: websocket\r\n'
+        'Connection: Upgrade\r\n'
+        'Sec-WebSocket-Key: %s\r\n'
+        'Origin: http://localhost\r\n'
+        'Sec-WebSocket-Version: 13\r\n'
+        '\r\n' % ( address[ 0 ], address[ 1 ],
+            base64.b64encode( os.urandom( 16 ) ) )
+    )
+
+    # read the response (the server may use bare newlines)
+    response = ''
+    while True:
+        data = sock.recv( 4096 )
+        if len( data ) == 0:
+            raise IOError( 'Server closed the connection during handshake.' )
+        response += data
+        for end in ( '\r\n\r\n', '\n\n' ):
+            index = response.find( end )
+            if index != -1:
+                break
+        if index != -1:
+            break
+    if response.split( None, 2 )[ 1 ] != '101':
+        raise IOError( 'Handshake failed: %s' % response.splitlines()[ 0 ] )
+
+    stream = websock.rfc6455.Stream()
+    stream.put( response[ ( index + len( end ) ) : ] )
+    sock.setblocking( 0 )
+    return ( sock, stream )
+
+
+#=============================================================================
+def masked_frame( payload, mask_key = None ):
+    """
+    Build a masked (client) text frame.
+    @param payload      Message payload
+    @param mask_key     Four byte masking key (default: random)
+    @return             Frame data
+    """
+
+    if mask_key is None:
+        mask_key = os.urandom( 4 )
+    length = len( payload )
+    if length > 65535:
+        header = struct.pack( '!BBQ', 0x81, ( 0x80 | 127 ), length )
+    elif length > 125:
+        header = struct.pack( '!BBH', 0x81, ( 0x80 | 126 ), length )
+    else:
+        header = struct.pack( '!BB', 0x81, ( 0x80 | length ) )
+    return header + mask_key + websock.unmask( payload, mask_key )
+
+
+#=============================================================================
+def percentile( values, fraction ):
+    """
+    Find a percentile of a sorted list of values.
+    @param values       Sorted values
+    @param fraction     Percentile as a fraction (e.g. 0.99)
+    @return             Value at the percentile (0 if there are no values)
+    """
+    if len( values ) == 0:
+        return 0.0
+    index = int( round( fraction * ( len( values ) - 1 ) ) )
+    return values[ index ]
+
+
+#=============================================================================
+def run( address, clients, size, rate, window, duration ):
+    """
+    Run a group of client connections from a single poll loop.
+    @param address      Server address
+    @param clients      Number of connections
+    @param size         Payload size of each message
+    @param rate         Messages per second for each connection (0 keeps
+                        window messages in flight instead)
+    @param window       Messages in flight for each connection without a
+                        rate
+    @param duration     Number of seconds to send messages
+    @return             Dict of results (see load())
+    """
+
+    payload = 'x' * size
+    echo    = payload.upper()
+    frame   = masked_frame( payload )
+    period  = ( 1.0 / rate ) if rate > 0 else 0.0
+
+    # per-connection state: socket, stream, send times of messages in
+    # flight, output buffer and offset, and time of the next scheduled send
+    poller = select.poll()
+    states = {}
+    for index in range( clients ):
+        ( sock, stream ) = connect( address )
+        states[ sock.fileno() ] = [
+            sock, stream, collections.deque(), None, 0, 0.0
+        ]
+        poller.register( sock.fileno(), select.POLLIN )
+
+    latencies = []
+    received  = 0
+    errors    = 0
+    start     = time.time()
+    stop      = start + duration
+    drain     = stop + 5.0
+    for index, state in enumerate( states.values() ):
+        state[ 5 ] = start + ( period * ( index / float( clients ) ) )
+
+    while len( states ) > 0:
+        now = time.time()
+        if ( now >= drain ) or ( ( now >= stop ) \
+            and all( len( s[ 2 ] ) == 0 for s in states.values() ) ):
+            break
+
+        # queue new messages, and send as much as each socket accepts
+        timeout = 0.05
+        for fd, state in states.items():
+            if ( now < stop ) and ( state[ 3 ] is None ):
+                if rate > 0:
+                    if now >= state[ 5 ]:
+                        state[ 3 ] = frame
+                        state[ 5 ] = max( ( state[ 5 ] + period ), now )
+                    timeout = min( timeout, max( 0.0, state[ 5 ] - now ) )
+                elif len( state[ 2 ] ) < window:
+                    state[ 3 ] = frame
+                if state[ 3 ] is not None:
+                    state[ 2 ].append( now )
+                    state[ 4 ] = 0
+            if state[ 3 ] is not None:
+                try:
+                    state[ 4 ] += state[ 0 ].send(
+                        buffer( state[ 3 ], state[ 4 ] )
+                    )
+                except socket.error as error:
+                    if error.args[ 0 ] not in ( errno.EAGAIN,
+                        errno.EWOULDBLOCK ):
+                        raise
+                if state[ 4 ] >= len( state[ 3 ] ):
+                    state[ 3 ] = None
+                    if ( rate == 0 ) and ( len( state[ 2 ] ) < window ):
+                        timeout = 0.0
+            poller.modify(
+                fd,
+                select.POLLIN | ( select.POLLOUT if state[ 3 ] else 0 )
+            )
+
+        # receive replies, and measure each message's round trip
+        for fd, event in poller.poll( timeout * 1000.0 ):
+            state = states[ fd ]
+            if event & select.POLLIN:
+                try:
+                    count = state[ 1 ].receive( state[ 0 ] )
+                except socket.error as error:
+                    if error.args[ 0 ] in ( errno.EAGAIN, errno.EWOULDBLOCK ):
+                        continue
+                    count = 0
+                if count == 0:
+                    errors += len( state[ 2 ] ) + 1
+                    poller.unregister( fd )
+                    del states[ fd ]
+                    continue
+                now = time.time()
+                while True:
+                    try:
+                        message = state[ 1 ].get_message()
+                    except ValueError:
+                        break
+                    sent = state[ 2 ].popleft()
+                    if message.get_payload() != echo:
+                        errors += 1
+                    latencies.append( now - sent )
+                    received += 1
+            elif event & ( select.POLLERR | select.POLLHUP ):
+                errors += len( state[ 2 ] ) + 1
+                poller.unregister( fd )
+                del states[ fd ]
+
+    for state in states.values():
+        state[ 0 ].close()
+
+    return {
+        'bytes'     : received * size,
+        'elapsed'   : time.time() - start,
+        'errors'    : errors,
+        'latencies' : latencies,
+        'messages'  : received
+    }
+
+
+#=============================================================================
+def _run( args ):
+    return run( *args )
+
+
+#=============================================================================
+def load(
+    address,
+    clients  = 10,
+    size     = 1024,
+    rate     = 0,
+    window   = 1,
+    duration = 10.0,
+    workers  = 1
+):
+    """
+    Generate load against a WebSocket echo server.
+    @param address      Server address
+    @param clients      Total number of connections
+    @param size         Payload size of each message
+    @param rate         Messages per second for each connection (0 keeps
+                        window messages in flight instead)
+    @param window       Messages in flight for each connection without a
+                        rate
+    @param duration     Number of seconds to send messages
+    @param workers      Number of client processes
+    @return             Dict of results: messages, bytes, elapsed, errors,
+                        messages/s, MB/s, and p50/p99 latency (seconds)
+    """
+
+    workers = max( 1, min( workers, clients ) )
+    groups  = [
+        ( address, ( ( clients + i ) // workers ), size, rate, window,
+            duration )
+        for i in range( workers )
+    ]
+    if workers == 1:
+        results = [ _run( groups[ 0 ] ) ]
+    else:
+        import multiprocessing
+        pool    = multiprocessing.Pool( workers )
+        results = pool.map( _run, groups )
+        pool.close()
+        pool.join()
+
+    latencies = sorted( l for r in results for l in r[ 'latencies' ] )
+    elapsed   = max( r[ 'elapsed' ] for r in results )
+    messages  = sum( r[ 'messages' ] for r in results )
+    nbytes    = sum( r[ 'bytes' ] for r in results )
+    return {
+        'bytes'    : nbytes,
+        'elapsed'  : elapsed,
+        'errors'   : sum( r[ 'errors' ] for r in results ),
+        'messages' : messages,
+        'mbps'     : nbytes / 1048576.0 / elapsed,
+        'mps'      : messages / elapsed,
+        'p50'      : percentile( latencies, 0.50 ),
+        'p99'      : percentile( latencies, 0.99 )
+    }
+
+
+#=============================================================================
+def serve( port, mode ):
+    """
+    Start a websock.py server in a separate process.
+    @param port         Listen port
+    @param mode         Server mode: 'thread', 'event', or 'processes'
+    @return             Server process (call terminate() to stop it)
+    """
+    import subprocess
+    import sys
+
+    script  = os.path.join( os.path.dirname( __file__ ), 'websock.py' )
+    command = [ sys.executable, script, '-p', str( port ) ]
+    if mode == 'thread':
+        command += [ '-m', 'thread' ]
+    elif mode == 'event':
+        command += [ '-m', 'event' ]
+    else:
+        command += [ '-m', 'event', '-n', str( _cpu_count() ) ]
+    process = subprocess.Popen( command )
+
+    # wait for the server to listen
+    for attempt in range( 100 ):
+        try:
+            socket.create_connection( ( 'localhost', port ) ).close()
+            return process
+        except socket.error:
+            time.sleep( 0.05 )
+    process.terminate()
+    raise IOError( 'Server did not start (%s mode).' % mode )
+
+
+#=============================================================================
+def _cpu_count():
+    import multiprocessing
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 2
+
+
+#=============================================================================
+def _report( label, result ):
+    print '%-10s %10.1f %9.2f %9.3f %9.3f %7d' % (
+        label,
+        result[ 'mps' ],
+        result[ 'mbps' ],
+        ( result[ 'p50' ] * 1000.0 ),
+        ( result[ 'p99' ] * 1000.0 ),
+        result[ 'errors' ]
+    )
+
+
+#=============================================================================
+def main( argv ):
+    """
+    Script execution entry point
+    @param argv         Arguments passed to the script
+    @return             Exit code (0 = success)
+    """
+
+    # imports when using this as a script
+    import argparse
+
+    # create and configure an argument parser
+    parser = argparse.ArgumentParser(
+        description = 'WebSocket Load Generator'
+    )
+    parser.add_argument(
+        '-p',
+        '--port',
+        default = 9999,
+        type    = int,
+        help    = 'Server TCP port (on localhost).'
+    )
+    parser.add_argument(
+        '-c',
+        '--clients',
+        default = 10,
+        type    = int,
+        help    = 'Number of concurrent connections.'
+    )
+    parser.add_argument(
+        '-s',
+        '--size',
+        default = 1024,
+        type    = int,
+        help    = 'Message payload size in bytes.'
+    )
+    parser.add_argument(
+        '-r',
+        '--rate',
+        default = 0.0,
+        type    = float,
+        help    = 'Messages per second per connection (0: closed loop).'
+    )
+    parser.add_argument(
+        '-w',
+        '--window',
+        default = 1,
+        type    = int,
+        help    = 'Messages in flight per connection (closed loop).'
+    )
+    parser.add_argument(
+        '-d',
+        '--duration',
+        default = 10.0,
+        type    = float,
+        help    = 'Number of seconds to send messages.'
+    )
+    parser.add_argument(
+        '-j',
+        '--workers',
+        default = 1,
+        type    = int,
+        help    = 'Number of client processes.'
+    )
+    parser.add_argument(
+        '--compare',
+        default = False,
+        help    = 'Start and measure each websock.py server mode in turn.',
+        action  = 'store_true'
+    )
+    parser.add_argument(
+        '-v',
+        '--version',
+        default = False,
+        help    = 'Display script version.',
+        action  = 'store_true'
+    )
+
+    # parse the arguments
+    args = parser.parse_args( argv[ 1 : ] )
+
+    # check for version request
+    if args.version == True:
+        print 'Version', __version__
+        return 0
+
+    options = dict(
+        clients  = args.clients,
+        size     = args.size,
+        rate     = args.rate,
+        window   = args.window,
+        duration = args.duration,
+        workers  = args.workers
+    )
+    address = ( 'localhost', args.port )
+
+    print '%-10s %10s %9s %9s %9s %7s' % (
+        'server', 'msgs/s', 'MB/s', 'p50 ms', 'p99 ms', 'errors'
+    )
+
+    # measure a running server
+    if args.compare == False:
+        _report( 'running', load( address, **options ) )
+        return 0
+
+    # start, measure, and stop each server mode
+    for mode in ( 'thread', 'event', 'processes' ):
+        process = serve( args.port, mode )
+        try:
+            _report( mode, load( address, **options ) )
+        finally:
+            process.terminate()
+            process.wait()
+
+    # return success
+    return 0
+
+
+#=============================================================================
+if __name__ == "__main__":
+    import sys
+    sys.exit( main( sys.argv ) )
@@ -20,7 +20,10 @@
 #
 ##############################################################################
 
-import math, operator, time
+import hashlib, math, operator, time
+
+# Member content hash used for de-duplication (BLAKE2 where available).
+_content_hash = getattr(hashlib, 'blake2b', hashlib.sha1);
 
 #=============================================================================
 # Manage information about an archived file.
@@ -37,6 +40,7 @@ class MTarInfo:
             gid     Numeric group ID (default: 0)
             size    Size of file in bytes (default: 0)
             mtime   Last modified time (default: current time)
+            link    Name of an earlier file to hard link to (default: None)
         """
         self.filename = filename;
         self.fields = {};
@@ -95,8 +99,11 @@ class MTarInfo:
         # The checksum field is temporarily filled with spaces.
         header += (' ' * 8);
 
-        # Set the link indicator to be a normal file.
-        header += '0';
+        # Set the link indicator to be a normal file or a hard link.
+        if self['link']:
+            header += '1' + self['link'] + ('\0' * (100 - len(self['link'])));
+        else:
+            header += '0';
 
         # Null pad header to 512 bytes.
         header += '\0' * (512 - len(header));
@@ -128,16 +135,21 @@ class MTarInfo:
 #=============================================================================
 class MTar:
 
-    def __init__(self, filename):
+    def __init__(self, filename, dedup=False):
         """
         Create a new MTar object, and open a new archive file.
         @param filename The name of the new archive file
+        @param dedup Store repeated file contents as hard links to the first
+            copy instead of writing the data again
         """
         self.filename = filename;
         self.fh = open(filename, 'wb');
         self.nblocks = 0;
         self.files = [];
         self.nindexes = 0;
+        self.indexed = 0;
+        self.dedup = dedup;
+        self.digests = {};
 
     def __del__(self):
         """
@@ -146,14 +158,15 @@ class MTar:
         self.close();
 
     @staticmethod
-    def open(filename):
+    def open(filename, dedup=False):
         """
         Convenience function for creating/opening a new MTar object.  This is
         provided to make it obvious that a file is being created during
         instantiation.
         @param filename The name of the new archive file
+        @param dedup Store repeated file contents as hard links
         """
-        return MTar(filename);
+        return MTar(filename, dedup);
 
     def close(self):
         """
@@ -169,6 +182,23 @@ class MTar:
         @param data The data (as a string) to write to the archive
         """
 
+        # Check for a previous copy of the same data.
+        if self.dedup:
+            digest = _content_hash(data).digest();
+            if digest in self.digests:
+                self.addLink(filename, self.digests[digest]);
+                return;
+            self.digests[digest] = len(self.files);
+
+        self._write(filename, data);
+
+    def _write(self, filename, data):
+        """
+        Write a file's header and data blocks to the archive.
+        @param filename The name of the file to write
+        @param data The data (as a string) to write to the archive
+        """
+
         # The string length is used as the "file" size.
         filesize = len(data);
 
@@ -185,25 +215,50 @@ class MTar:
         theader = MTarInfo(filename, size=filesize);
 
         # Calculate the amount of block padding needed for the last block.
-        nullpad = 512 - (filesize % 512);
+        nullpad = (512 - (filesize % 512)) % 512;
 
         # Write the header, data, and null pad.
         self.fh.write(str(theader) + data + ('\0' * nullpad));
 
+    def addLink(self, filename, index):
+        """
+        Add a hard link to a file that is already in the archive.  The link
+        does not occupy any data blocks.  Its index entry uses the size and
+        block position of the original file's data so readers can extract it
+        without resolving the link.
+        @param filename The name of the link to write
+        @param index The index of the original file in the archive
+        """
+
+        # Point the index entry at the original file's data.
+        target = self.files[index];
+        self.files.append([filename] + target[1:]);
+
+        # The link is a header block with no data.
+        self.nblocks += 1;
+        self.fh.write(str(MTarInfo(filename, link=target[0])));
+
     def addIndex(self):
         """
         Write an index file to the current point in the tar file.  This is
         intended for more advanced tools to more quickly find individual
         files without searching the entire archive.  For small archives, this
-        may not provide a significant improvement in performance.
+        may not provide a significant improvement in performance.  Nothing
+        is written if no files were added since the last index.
         """
 
+        # The last index (if any) already lists every file.
+        if len(self.files) == self.indexed:
+            return;
+
         # Create the index.
         data = "\n".join(map(lambda f: ','.join(map(str, f)), self.files));
 
-        # Add the index as a new file.
-        self.add(('.tarindex_%d.csv' % self.nindexes), data);
+        # Add the index as a new file (never as a link to an earlier index,
+        # since readers search backwards for the index data).
+        self._write(('.tarindex_%d.csv' % self.nindexes), data);
         self.nindexes += 1;
+        self.indexed = len(self.files);
 
 
 #-----------------------------------------------------------------------------
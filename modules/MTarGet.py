@@ -9,7 +9,9 @@
 #   Python: 2.6
 #
 #   Helper class to extract specific files from an indexed tar archive
-#   created by the MTar library using the index feature.
+#   created by the MTar library using the index feature.  Archives without
+#   an index are scanned once, and the result is saved to a ".tarindex"
+#   sidecar file next to the archive.
 #
 ##############################################################################
 
@@ -88,9 +90,115 @@ class MTarGet:
                 else:
                     break;
 
+            # Without an index, fall back to the sidecar or a header scan.
+            if len(self.files) == 0:
+                self.files = self._loadSidecar(fh);
+
             # Close the archive.
             fh.close();
 
+    def _loadSidecar(self, fh):
+        """
+        Load the file list from the archive's sidecar index.  If the sidecar
+        is missing or stale, build the list by walking the tar headers, and
+        save it for the next time the archive is opened.
+        @param fh The open archive file handle
+        @return The list of files in the same format as an MTar index
+        """
+
+        # The sidecar is keyed by the archive's size and modified time.
+        st = os.stat(self.filename);
+        key = '%d,%r' % (st.st_size, st.st_mtime);
+        sidecar = self.filename + '.tarindex';
+
+        # Attempt to use a previously-saved index.
+        try:
+            sfh = open(sidecar, 'rb');
+        except IOError:
+            pass;
+        else:
+            lines = sfh.read().splitlines();
+            sfh.close();
+            if (len(lines) > 0) and (lines[0] == key):
+                return [line.rsplit(',', 3) for line in lines[1:]];
+
+        # Build the index from the archive's headers.
+        files = MTarGet.scan(fh);
+
+        # Save the index for future lookups (a read-only location is fine).
+        try:
+            sfh = open(sidecar, 'wb');
+        except IOError:
+            pass;
+        else:
+            sfh.write("\n".join([key] + map(lambda f: ','.join(f), files)));
+            sfh.close();
+
+        return files;
+
+    @staticmethod
+    def scan(fh):
+        """
+        Build an index of an archive by walking its 512-byte headers.  Each
+        header's size field is used to seek past the member's data, so the
+        file data itself is never read.  This works on archives created by
+        any tar program.
+        @param fh A file handle opened on the archive
+        @return A list of lists containing each file's name, size, archive
+            block position, and number of blocks (512 bytes/block)
+        """
+        files = [];
+        names = {};
+        block = 0;
+        longname = None;
+        fh.seek(0);
+
+        # Header read loop.
+        while True:
+
+            # Stop at the end of the file or the end-of-archive null block.
+            header = fh.read(512);
+            if (len(header) < 512) or (header == ('\0' * 512)):
+                break;
+
+            # Parse the fields needed to locate the member data.
+            name = header[:100].split('\0', 1)[0];
+            size = int(header[124:136].strip(' \0') or '0', 8);
+            link = header[156];
+            nblocks = (size + 511) // 512;
+
+            # The ustar format splits long names into a prefix and a name.
+            if header[257:262] == 'ustar':
+                prefix = header[345:500].split('\0', 1)[0];
+                if prefix:
+                    name = prefix + '/' + name;
+
+            # GNU long names store the next member's name as data.
+            if link == 'L':
+                longname = fh.read(size).split('\0', 1)[0];
+
+            # Skip extended headers, and record everything else.
+            elif link not in ('x', 'g', 'K'):
+                if longname is not None:
+                    name = longname;
+                    longname = None;
+                record = [name, str(size), str(block + 1), str(nblocks)];
+
+                # Hard links resolve to the data of the linked file.
+                if link == '1':
+                    target = header[157:257].split('\0', 1)[0];
+                    if target in names:
+                        record = [name] + names[target][1:];
+
+                names[name] = record;
+                files.append(record);
+
+            # Move the read head past the member's data to the next header.
+            block += 1 + nblocks;
+            fh.seek(block * 512);
+
+        return files;
+
     def getIndex(self):
         """
         Provide the complete list of files in the archive with index details.
@@ -6,30 +6,53 @@
 ##############################################################################
 
 
+import string
 import struct
 
 
+# translation of sample levels (0 or 1) to binary digits
+_digits = string.maketrans( '\x00\x01', '01' )
+
+
 #=============================================================================
 class bitbang:
     """
     Provides a mechanism for bit-bang decoding of RS-232 data.
-    This implementation assumes 1 start bit, 8 data bits, no parity bit, and
-    1 stop bit.  This also assumes front-end level shifting has normalized
-    sample levels such that a sampled "0" corresponds to a "0" symbol.
-    Sequence framing is outside of the scope of this decoder.
+    This implementation assumes 1 start bit, and defaults to 8 data bits, no
+    parity bit, and 1 stop bit.  This also assumes front-end level shifting
+    has normalized sample levels such that a sampled "0" corresponds to a "0"
+    symbol.  Sequence framing is outside of the scope of this decoder.
     """
 
     #=========================================================================
-    def __init__( self, bitrate, samplerate ):
+    def __init__(
+        self,
+        bitrate,
+        samplerate,
+        databits = 8,
+        parity   = None,
+        stopbits = 1
+    ):
         """
         Initialize bitbang object.
         @param bitrate The RS-232 bit rate (Hz) (e.g. 9600, 115200, etc)
         @param samplerate The rate at which the serial line was sampled (Hz)
+        @param databits Number of data bits in each frame
+        @param parity Parity bit type: None, 'even', or 'odd'
+        @param stopbits Number of stop bits in each frame
         """
 
         # set samples per bit timing value
         self.sperb = float( samplerate ) / float( bitrate )
 
+        # set frame format
+        self.databits = databits
+        self.parity   = parity
+        self.stopbits = stopbits
+
+        # determine the sample positions used by put_sample() in each frame
+        self._timing()
+
         # initialize object state
         self.reset()
 
@@ -51,40 +74,113 @@ class bitbang:
         @param sample The sampled input level (0 or 1)
         """
 
+        # count samples to report the time of each frame
+        self.count += 1
+
         # detect front edge of start bit
         if ( self.idle == True ) and ( sample == 0 ):
 
-            # start the sample timer ahead half a bit width so when it expires
-            # the timer will be in the middle of the first data bit
-            self.timer = 0.5 * self.sperb
+            # start the sample timer behind half a bit width so when it
+            # expires the timer will be in the middle of the first data bit
+            # (one and a half bit widths after the edge)
+            self.timer = -0.5 * self.sperb
             self.idle  = False
+            self.start = self.count - 1
 
         # check for non-idle sample time
         elif self.idle == False:
 
-            # check for an expired sample timer
-            if self.timer > self.sperb:
+            # count the sample, and check for an expired sample timer
+            self.timer += 1.0
+            if self.timer >= self.sperb:
 
-                # reset sample timer
-                self.timer = 0.0
+                # restart the sample timer (keeping the fraction of a sample
+                # so sample times do not drift through the frame)
+                self.timer -= self.sperb
 
-                # see if we've already clocked in enough bits
-                if self.bits == 8:
+                # see if we've reached the last stop bit
+                if self.bits == self._last:
 
                     # store the captured byte
-                    self.data.append( self.byte )
+                    self._store(
+                        self.byte,
+                        self.check,
+                        ( self.framed == True ) and ( sample == 1 )
+                    )
 
                     # reset internal state
                     self._reset()
 
-                # all other sample times are during data bits
-                else:
+                # sample times during data bits
+                elif self.bits < self.databits:
                     self.byte |= sample << self.bits
                     self.bits += 1
 
-            # sample timer still counting up
+                # sample times during parity and other stop bits
+                else:
+                    if ( self.bits == self.databits ) \
+                        and ( self.parity is not None ):
+                        self.check = sample
+                    elif sample == 0:
+                        self.framed = False
+                    self.bits += 1
+
+    #=========================================================================
+    def put_samples( self, samples ):
+        """
+        Add a buffer of input level samples to the serial stream.  This
+        decodes the same data as calling put_sample() for each sample, but
+        searches for start bits in bulk, and decodes each frame in one step.
+        Frames may span buffers.
+        @param samples String, bytearray, memoryview, array, or NumPy array
+                       of sampled input levels (0 or 1)
+        """
+
+        # normalize the samples to a string with one byte per sample
+        if type( samples ) is not str:
+            if hasattr( samples, 'astype' ):
+                samples = samples.astype( 'uint8' ).tostring()
+            elif isinstance( samples, memoryview ):
+                samples = samples.tobytes()
             else:
-                self.timer += 1.0
+                samples = str( bytearray( samples ) )
+
+        # finish any frame that was started in a previous buffer
+        base     = self.count
+        position = 0
+        length   = len( samples )
+        while ( self.idle == False ) and ( position < length ):
+            self.put_sample( ord( samples[ position ] ) )
+            position += 1
+
+        # decode each complete frame in the buffer
+        while True:
+
+            # find the front edge of the next start bit
+            edge = samples.find( '\x00', position )
+            if edge == -1:
+                self.count = base + length
+                break
+
+            # leave frames that span the end of the buffer to the state machine
+            if ( edge + self._length ) > length:
+                self.count = base + edge
+                for sample in samples[ edge : ]:
+                    self.put_sample( ord( sample ) )
+                break
+
+            # pull each data bit sample, and assemble the byte (LSbit first)
+            bits = ''.join( [ samples[ edge + o ] for o in self._data ] )
+            stop = ''.join( [ samples[ edge + o ] for o in self._stop ] )
+            self.start = base + edge
+            self._store(
+                int( bits[ : : -1 ].translate( _digits ), 2 ),
+                ord( samples[ edge + self._offsets[ self.databits ] ] ),
+                stop.find( '\x00' ) == -1
+            )
+
+            # resume searching after the last stop bit sample
+            position = edge + self._length
 
     #=========================================================================
     def reset( self ):
@@ -92,25 +188,233 @@ class bitbang:
         Reset object to begin a fresh acquisition.
         """
         self._reset()
-        self.data = []
+        self.count  = 0
+        self.data   = []
+        self.errors = 0
+        self.times  = []
 
     #=========================================================================
     def _reset( self ):
-        self.bits  = 0
-        self.byte  = 0
-        self.idle  = True
+        self.bits   = 0
+        self.byte   = 0
+        self.check  = 0
+        self.framed = True
+        self.idle   = True
+        self.start = 0
         self.timer = 0.0
 
+    #=========================================================================
+    def _store( self, byte, check, framed ):
+        """
+        Store a captured byte, the sample number of its start bit, and count
+        parity and framing errors (a stop bit that was not sampled as "1").
+        Each frame counts at most one error.
+        """
+        self.data.append( byte )
+        self.times.append( self.start )
+        if self.parity is not None:
+            odd = ( bin( byte ).count( '1' ) + check ) & 1
+            if odd != ( self.parity == 'odd' ):
+                self.errors += 1
+                return
+        if framed == False:
+            self.errors += 1
+
+    #=========================================================================
+    def _timing( self ):
+        """
+        Determine the number of samples from a start bit edge to each bit
+        sample (data bits, parity bit, and stop bits) by running the same
+        timer arithmetic as put_sample().
+        """
+
+        # bit samples following the first data bit sample
+        self._last = self.databits + self.stopbits - 1
+        if self.parity is not None:
+            self._last += 1
+
+        # samples from the start bit edge to each bit sample
+        self._offsets = []
+        offset = 0
+        timer  = -0.5 * self.sperb
+        while len( self._offsets ) <= self._last:
+            offset += 1
+            timer  += 1.0
+            if timer >= self.sperb:
+                timer -= self.sperb
+                self._offsets.append( offset )
+        self._data = self._offsets[ : self.databits ]
+        self._stop = self._offsets[ ( self._last + 1 - self.stopbits ) : ]
+
+        # samples from the edge through the last stop bit sample (inclusive)
+        self._length = self._offsets[ -1 ] + 1
+
+
+#=============================================================================
+class multichannel:
+    """
+    Decodes several serial lines that were sampled together.  Samples are
+    interleaved with one byte per channel per sample time (e.g. channel 0,
+    channel 1, ..., channel 0, channel 1, ...).  Each channel is decoded by
+    its own bitbang state machine.
+    """
+
+    #=========================================================================
+    def __init__( self, channels, bitrate, samplerate, **kwargs ):
+        """
+        Initialize multichannel object.
+        @param channels Number of interleaved channels
+        @param bitrate The RS-232 bit rate (Hz)
+        @param samplerate The rate at which the lines were sampled (Hz)
+        @param **kwargs Frame format (see bitbang: databits, parity, stopbits)
+        """
+        self.channels   = channels
+        self.bitrate    = bitrate
+        self.samplerate = float( samplerate )
+        self.kwargs     = kwargs
+        self.decoders   = [
+            bitbang( bitrate, samplerate, **kwargs ) for c in range( channels )
+        ]
+
+    #=========================================================================
+    def decode( self, source, chunk_size = 1048576 ):
+        """
+        Decode a stream of interleaved samples.
+        @param source String (or other buffer) of samples, or a file-like
+                      object from which samples are read
+        @param chunk_size Number of samples per channel to decode at a time
+        @return Generator of ( time, channel, byte ) tuples in time order
+                (time is in seconds from the start of the samples)
+        """
+
+        # read (or slice) the source in chunks of whole sample times
+        held   = []
+        size   = chunk_size * self.channels
+        offset = 0
+        while True:
+            if hasattr( source, 'read' ):
+                chunk = source.read( size )
+            else:
+                chunk = source[ offset : ( offset + size ) ]
+                offset += size
+            if len( chunk ) == 0:
+                break
+
+            # decode each channel
+            for channel in range( self.channels ):
+                self.decoders[ channel ].put_samples(
+                    _deinterleave( chunk, channel, self.channels )
+                )
+
+            # report everything decoded so far, except events that are not
+            # earlier than a frame still being received on any channel (the
+            # frame is reported after the next chunk, and must come first)
+            events = sorted( held + list( self._events() ) )
+            starts = [
+                decoder.start for decoder in self.decoders
+                if decoder.idle == False
+            ]
+            count = len( events )
+            if len( starts ) > 0:
+                cutoff = min( starts ) / self.samplerate
+                while ( count > 0 ) and ( events[ count - 1 ][ 0 ] >= cutoff ):
+                    count -= 1
+            held = events[ count : ]
+            for event in events[ : count ]:
+                yield event
+
+        # report the events held back after the last chunk
+        for event in held:
+            yield event
+
+    #=========================================================================
+    def decode_parallel( self, samples, processes = None ):
+        """
+        Decode a complete capture of interleaved samples using a process pool
+        (one task per channel).
+        @param samples String (or other buffer) of samples
+        @param processes Number of worker processes (default: CPU count)
+        @return Generator of ( time, channel, byte ) tuples in time order
+                (parity and framing errors are counted in each channel's
+                decoder, the same as decode())
+        """
+        import multiprocessing
+        pool = multiprocessing.Pool( processes )
+        try:
+            results = pool.map(
+                _decode_channel,
+                [
+                    (
+                        self.bitrate,
+                        self.samplerate,
+                        self.kwargs,
+                        _deinterleave( samples, channel, self.channels )
+                    )
+                    for channel in range( self.channels )
+                ]
+            )
+        finally:
+            pool.close()
+            pool.join()
+        for channel in range( self.channels ):
+            ( data, times, errors ) = results[ channel ]
+            self.decoders[ channel ].data.extend( data )
+            self.decoders[ channel ].times.extend( times )
+            self.decoders[ channel ].errors += errors
+        return self._events()
+
+    #=========================================================================
+    def _events( self ):
+        """
+        Collect and clear the decoded bytes from all channels in time order.
+        """
+        events = []
+        for channel in range( self.channels ):
+            decoder = self.decoders[ channel ]
+            events.extend(
+                ( ( start / self.samplerate ), channel, byte )
+                for ( start, byte ) in zip( decoder.times, decoder.data )
+            )
+            del decoder.data[ : ]
+            del decoder.times[ : ]
+        events.sort()
+        return iter( events )
+
+
+#=============================================================================
+def _decode_channel( args ):
+    """
+    Decode all the samples for one channel (process pool task).
+    """
+    ( bitrate, samplerate, kwargs, samples ) = args
+    decoder = bitbang( bitrate, samplerate, **kwargs )
+    decoder.put_samples( samples )
+    return ( decoder.data, decoder.times, decoder.errors )
+
+
+#=============================================================================
+def _deinterleave( samples, channel, channels ):
+    """
+    Select the samples for one channel from interleaved samples.  A strided
+    memoryview is used when it is supported (avoids a copy).
+    """
+    try:
+        return memoryview( samples )[ channel : : channels ]
+    except ( NotImplementedError, TypeError, ValueError ):
+        return samples[ channel : : channels ]
+
 
 #=============================================================================
 class bitbang_test:
     def __init__( self, bb ):
-        self.bb   = bb
-        self.time = 0
+        self.bb      = bb
+        self.time    = 0
+        self.samples = []
     def put_bit( self, level ):
         bit_time = self.time
         while ( self.time - bit_time ) < self.bb.sperb:
             self.bb.put_sample( level )
+            self.samples.append( level )
             self.time += 1
 
 
@@ -145,6 +449,14 @@ def main( argv ):
     else:
         print 'Failed to decode data: 0x%02X != 0x%02X.' % ( byte, test_byte )
 
+    # test bulk decoding of the same samples
+    bulk = bitbang( 115200, 2000000 )
+    bulk.put_samples( bytearray( test.samples ) )
+    if bulk.get_data() == data:
+        print 'Bulk decoding matches sample decoding.'
+    else:
+        print 'Bulk decoding does not match sample decoding.'
+
     # Return success.
     return 0
 
@@ -3,11 +3,6 @@
 #
 # bitstruct.py
 #
-# TODO:
-#   - refactor implementation into bitsruct class, and keep functions as a
-#       convenience interface
-#   - optimize string spec parsing
-#
 ##############################################################################
 
 """
@@ -55,30 +50,293 @@ List Specifiers
         [ (6,2,'I2C'), (2,4,'SPI'), (1,1,'LED1'), (0,1,'LED0') ]
         --> returns something like this:
         { 'I2C' : 3, 'SPI' : 12, 'LED1' : 0, 'LED0' : 1 }
+
+Compiled Specifiers
+    Parsing a specifier is much slower than using it.  The compile() function
+    parses a specifier once, and returns a bitstruct object with pack() and
+    unpack() methods generated specifically for that specifier (constant
+    shifts and masks, no loops).  The module-level functions keep a cache of
+    recently-used compiled specifiers, so repeated calls with the same
+    specifier only pay for parsing once.
+
+    Example:
+        fields = compile( 'aabb bbcd' )
+        fields.unpack( 0xA5 )
+        --> [ 2, 9, 0, 1 ]
+
+Word Arrays
+    Buffers of packed words (strings, memoryviews, mmaps, etc) are decoded in
+    bulk using unpack_array().  Each field is returned as an array of values
+    (in a list or dictionary like unpack()).  If NumPy is available, the
+    arrays are NumPy arrays computed with vectorized shifts and masks.
+    Otherwise, they are array.array objects.  pack_array() is the reverse.
+
+    Example:
+        unpack_array( 'aaaa bbbb', '\x12\x34', 1, '<' )
+        --> [ array( 'B', [ 1, 3 ] ), array( 'B', [ 2, 4 ] ) ]
+
+Bit Streams
+    Fields that do not line up with bytes or words (e.g. variable-length
+    protocol fields) are read and written sequentially with BitReader and
+    BitWriter.  Bits are streamed MSbit first.  Both classes work on strings
+    or files (including mmaps), and move data in large chunks internally, so
+    very large streams are processed in constant memory.
+
+    Example:
+        reader = BitReader( '\xA5\x0F' )
+        reader.read( 3 )
+        --> 5
+        reader.read_spec( 'aabb bbcd' )
+        --> [ 0, 10, 0, 0 ]
 """
 
 
+import array
+import binascii
+import collections
+import sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# array.array type codes to try for each word size (in bytes)
+_array_codes = 'BHILQ'
+
+
+# maximum number of compiled specifiers kept by the module-level functions
+_cache_size = 256
+
+# compiled specifiers, in least- to most-recently used order
+_cache = collections.OrderedDict()
+
+
 #=============================================================================
 class bitstruct:
     """
-    Improved performance version of bare module functions.
-    This just does all the spec parsing/checking at once instead of every time
-    one of the functions are called.
-    In the future, this should contain the normal implementation, and the
-    module functions will just create one of these on the fly, and invoke
-    the appropriate method.
+    Compiled format specifier.
+    All the spec parsing/checking is done once, and the pack() and unpack()
+    methods are generated as straight-line functions with the shifts and
+    masks for each field built in.  The module functions use a cache of
+    these objects.
     """
     def __init__( self, spec ):
         if type( spec ) is str:
             spec = _spec_str_to_list( spec )
         self.spec = spec
         self.size = calcsize( spec )
+        self.width = max( [ f[ 0 ] + f[ 1 ] for f in spec ] + [ 0 ] )
+        ( self.pack, self.unpack ) = _generate( spec )
     def calcsize( self ):
         return self.size
-    def pack( self, values ):
-        return pack( self.spec, values )
-    def unpack( self, data ):
-        return unpack( self.spec, data )
+    def unpack_array( self, buffer, word_size = 4, byteorder = '<' ):
+        return _unpack_array( self.spec, buffer, word_size, byteorder )
+    def pack_array( self, values, word_size = 4, byteorder = '<' ):
+        return _pack_array( self.spec, values, word_size, byteorder )
+
+
+#=============================================================================
+class BitReader:
+    """
+    Sequential reader of arbitrary-width fields from a bit stream.
+    """
+
+    #=========================================================================
+    def __init__( self, source, chunk_size = 1048576 ):
+        """
+        Initialize a BitReader object.
+        @param source String, bytearray, memoryview, or file-like object
+                      (anything with a read() method, including mmaps)
+        @param chunk_size Number of bytes to pull from the source at a time
+        """
+        self.source     = source
+        self.chunk_size = chunk_size
+        self._chunk     = ''
+        self._offset    = 0
+        self._position  = 0
+        self._consumed  = 0
+
+    #=========================================================================
+    def align( self ):
+        """
+        Skip any remaining bits in the current byte.
+        """
+        self._position = ( self._position + 7 ) & ~7
+
+    #=========================================================================
+    def read( self, length ):
+        """
+        Read an unsigned integer field from the stream.
+        @param length Width of the field in bits
+        @return The field's value
+        @throws EOFError if the stream does not contain enough bits
+        """
+        end = self._position + length
+        if end > ( len( self._chunk ) * 8 ):
+            self._fill( end )
+            end = self._position + length
+        first = self._position >> 3
+        last  = ( end + 7 ) >> 3
+        data  = self._chunk[ first : last ]
+        value = int( binascii.hexlify( data ), 16 ) if len( data ) else 0
+        self._position = end
+        return ( value >> ( ( last << 3 ) - end ) ) & _length_to_mask( length )
+
+    #=========================================================================
+    def read_spec( self, spec ):
+        """
+        Read and unpack one word described by a format specifier.
+        @param spec Format specifier (or compiled bitstruct object)
+        @return List or dictionary of field values
+        """
+        if not isinstance( spec, bitstruct ):
+            spec = compile( spec )
+        return spec.unpack( self.read( spec.width ) )
+
+    #=========================================================================
+    def tell( self ):
+        """
+        Report the number of bits read from the start of the stream.
+        """
+        return ( self._consumed * 8 ) + self._position
+
+    #=========================================================================
+    def _fill( self, end ):
+        # discard consumed bytes, and append new chunks until enough bits are
+        # buffered to satisfy a read ending at the given bit position
+        keep   = self._position >> 3
+        chunks = [ self._chunk[ keep : ] ]
+        size   = len( chunks[ 0 ] )
+        need   = ( ( end + 7 ) >> 3 ) - keep
+        while size < need:
+            chunk = self._read_chunk()
+            if len( chunk ) == 0:
+                raise EOFError( 'not enough bits in stream' )
+            chunks.append( chunk )
+            size += len( chunk )
+        self._chunk     = ''.join( chunks )
+        self._consumed += keep
+        self._position -= keep << 3
+
+    #=========================================================================
+    def _read_chunk( self ):
+        if hasattr( self.source, 'read' ):
+            return self.source.read( self.chunk_size )
+        chunk = self.source[ self._offset : self._offset + self.chunk_size ]
+        self._offset += len( chunk )
+        if isinstance( chunk, memoryview ):
+            return chunk.tobytes()
+        return str( chunk )
+
+
+#=============================================================================
+class BitWriter:
+    """
+    Sequential writer of arbitrary-width fields to a bit stream.
+    """
+
+    #=========================================================================
+    def __init__( self, target = None, chunk_size = 1048576 ):
+        """
+        Initialize a BitWriter object.
+        @param target File-like object to write, or None to collect the
+                      stream in memory (see getvalue())
+        @param chunk_size Number of bytes to buffer before writing the target
+        """
+        self.target     = target
+        self.chunk_size = chunk_size
+        self._bits      = 0
+        self._length    = 0
+        self._chunks    = []
+        self._size      = 0
+
+    #=========================================================================
+    def flush( self ):
+        """
+        Pad the stream with zero bits to a byte boundary, and write all
+        buffered data to the target.
+        """
+        if self._length & 7:
+            self.write( 0, 8 - ( self._length & 7 ) )
+        self._emit( 0 )
+        if self.target is not None:
+            self.target.write( ''.join( self._chunks ) )
+            self._chunks = []
+            self._size   = 0
+
+    #=========================================================================
+    def getvalue( self ):
+        """
+        Flush the stream, and return everything written to memory.
+        @return Byte string of the stream
+        """
+        self.flush()
+        return ''.join( self._chunks )
+
+    #=========================================================================
+    def write( self, value, length ):
+        """
+        Write an unsigned integer field to the stream.
+        @param value The field's value
+        @param length Width of the field in bits
+        """
+        self._bits = ( self._bits << length ) \
+            | ( value & _length_to_mask( length ) )
+        self._length += length
+        if self._length >= 512:
+            self._emit( self.chunk_size )
+
+    #=========================================================================
+    def write_spec( self, spec, values ):
+        """
+        Pack and write one word described by a format specifier.
+        @param spec Format specifier (or compiled bitstruct object)
+        @param values List or dictionary of field values
+        """
+        if not isinstance( spec, bitstruct ):
+            spec = compile( spec )
+        self.write( spec.pack( values ), spec.width )
+
+    #=========================================================================
+    def _emit( self, limit ):
+        # move whole bytes from the bit accumulator to the chunk list, and
+        # write the chunks out once they exceed the given size
+        count = self._length >> 3
+        if count > 0:
+            self._length -= count << 3
+            data = self._bits >> self._length
+            self._bits &= _length_to_mask( self._length )
+            self._chunks.append(
+                binascii.unhexlify( '%0*x' % ( ( count * 2 ), data ) )
+            )
+            self._size += count
+        if ( self.target is not None ) and ( self._size >= limit > 0 ):
+            self.target.write( ''.join( self._chunks ) )
+            self._chunks = []
+            self._size   = 0
+
+
+#=============================================================================
+def compile( spec ):
+    """
+    Compile a format specifier into a bitstruct object with generated pack()
+    and unpack() methods.  Compiled specifiers are cached, so compiling the
+    same specifier again is cheap.
+    """
+    if type( spec ) is str:
+        key = spec
+    else:
+        key = tuple( tuple( field ) for field in spec )
+    try:
+        compiled = _cache.pop( key )
+    except KeyError:
+        compiled = bitstruct( spec )
+        if len( _cache ) >= _cache_size:
+            _cache.popitem( last = False )
+    _cache[ key ] = compiled
+    return compiled
 
 
 #=============================================================================
@@ -104,18 +362,7 @@ def pack( spec, values ):
     Pack a list or dictionary of integer values into an integer according
     to the given format specifier.
     """
-    if type( spec ) is str:
-        spec = _spec_str_to_list( spec )
-    data = 0
-    if len( spec[ 0 ] ) >= 3:
-        for field in spec:
-            data |= ( values[ field[ 2 ] ] & _length_to_mask( field[ 1 ] ) ) \
-                << field[ 0 ]
-        return data
-    for i in range( len( spec ) ):
-        data |= ( values[ i ] & _length_to_mask( spec[ i ][ 1 ] ) ) \
-            << spec[ i ][ 0 ]
-    return data
+    return compile( spec ).pack( values )
 
 
 #=============================================================================
@@ -124,17 +371,134 @@ def unpack( spec, data ):
     Unpack an integer into a list or dictionary of integer values according
     to the given format specifier.
     """
-    if type( spec ) is str:
-        spec = _spec_str_to_list( spec )
-    if len( spec[ 0 ] ) >= 3:
+    return compile( spec ).unpack( data )
+
+
+#=============================================================================
+def unpack_array( spec, buffer, word_size = 4, byteorder = '<' ):
+    """
+    Unpack a buffer of packed words into a list or dictionary of arrays (one
+    array of values per field) according to the given format specifier.
+    Trailing bytes that do not make up a full word are ignored.
+    @param spec Format specifier
+    @param buffer String, bytearray, memoryview, or mmap of packed words
+    @param word_size Number of bytes in each word
+    @param byteorder Byte order of each word: '<' (little) or '>' (big)
+    @return List or dictionary of field value arrays
+    """
+    return compile( spec ).unpack_array( buffer, word_size, byteorder )
+
+
+#=============================================================================
+def pack_array( spec, values, word_size = 4, byteorder = '<' ):
+    """
+    Pack a list or dictionary of field value sequences (as returned by
+    unpack_array()) into a string of packed words.
+    @param spec Format specifier
+    @param values List or dictionary of field value sequences
+    @param word_size Number of bytes in each word
+    @param byteorder Byte order of each word: '<' (little) or '>' (big)
+    @return Byte string of packed words
+    """
+    return compile( spec ).pack_array( values, word_size, byteorder )
+
+
+#=============================================================================
+def _array_code( word_size ):
+    for code in _array_codes:
+        try:
+            if array.array( code ).itemsize == word_size:
+                return code
+        except ValueError:
+            pass
+    raise ValueError( 'unsupported word size: %d' % word_size )
+
+
+#=============================================================================
+def _field_keys( spec ):
+    if ( len( spec ) > 0 ) and ( len( spec[ 0 ] ) >= 3 ):
+        return ( True, [ field[ 2 ] for field in spec ] )
+    return ( False, list( range( len( spec ) ) ) )
+
+
+#=============================================================================
+def _pack_array( spec, values, word_size, byteorder ):
+    ( keyed, keys ) = _field_keys( spec )
+    if len( keys ) == 0:
+        return ''
+    swap = ( byteorder == '>' ) != ( sys.byteorder == 'big' )
+
+    # vectorized packing
+    if numpy is not None:
+        dtype = numpy.dtype( 'u%d' % word_size )
+        words = numpy.zeros( len( values[ keys[ 0 ] ] ), dtype )
+        for key, field in zip( keys, spec ):
+            words |= ( numpy.asarray( values[ key ] ).astype( dtype )
+                & dtype.type( _length_to_mask( field[ 1 ] ) ) ) \
+                << dtype.type( field[ 0 ] )
+        if swap == True:
+            words.byteswap( True )
+        return _to_bytes( words )
+
+    # packing with array module
+    words = [ 0 ] * len( values[ keys[ 0 ] ] )
+    for key, field in zip( keys, spec ):
+        mask   = _length_to_mask( field[ 1 ] )
+        offset = field[ 0 ]
+        words  = [ word | ( ( value & mask ) << offset )
+            for word, value in zip( words, values[ key ] ) ]
+    words = array.array( _array_code( word_size ), words )
+    if swap == True:
+        words.byteswap()
+    return _to_bytes( words )
+
+
+#=============================================================================
+def _to_bytes( words ):
+    if hasattr( words, 'tobytes' ):
+        return words.tobytes()
+    return words.tostring()
+
+
+#=============================================================================
+def _unpack_array( spec, buffer, word_size, byteorder ):
+    ( keyed, keys ) = _field_keys( spec )
+    if keyed == True:
         values = {}
-        for field in spec:
-            values[ field[ 2 ] ] = ( data >> field[ 0 ] ) \
-                & _length_to_mask( field[ 1 ] )
+    else:
+        values = [ None ] * len( spec )
+    count = len( buffer ) // word_size
+
+    # vectorized unpacking
+    if numpy is not None:
+        dtype = numpy.dtype( 'u%d' % word_size ).newbyteorder( byteorder )
+        words = numpy.frombuffer( buffer, dtype, count ).astype(
+            dtype.newbyteorder( '=' )
+        )
+        for key, field in zip( keys, spec ):
+            values[ key ] = ( words >> words.dtype.type( field[ 0 ] ) ) \
+                & words.dtype.type( _length_to_mask( field[ 1 ] ) )
         return values
-    values = []
-    for field in spec:
-        values.append( ( data >> field[ 0 ] ) & _length_to_mask( field[ 1 ] ) )
+
+    # unpacking with array module
+    code  = _array_code( word_size )
+    words = array.array( code )
+    if isinstance( buffer, memoryview ):
+        buffer = buffer.tobytes()
+    data = buffer[ : ( count * word_size ) ]
+    if hasattr( words, 'frombytes' ):
+        words.frombytes( data )
+    else:
+        words.fromstring( str( data ) )
+    if ( byteorder == '>' ) != ( sys.byteorder == 'big' ):
+        words.byteswap()
+    for key, field in zip( keys, spec ):
+        mask   = _length_to_mask( field[ 1 ] )
+        offset = field[ 0 ]
+        values[ key ] = array.array(
+            code,
+            [ ( word >> offset ) & mask for word in words ]
+        )
     return values
 
 
@@ -147,6 +511,45 @@ def _count_set_bits( data ):
     return count
 
 
+#=============================================================================
+def _generate( spec ):
+    """
+    Generate straight-line pack and unpack functions for a list specifier.
+    Field keys are passed into the generated code as variables so any
+    hashable key may be used.
+    """
+    keyed   = ( len( spec ) > 0 ) and ( len( spec[ 0 ] ) >= 3 )
+    names   = {}
+    packs   = []
+    unpacks = []
+    for i in range( len( spec ) ):
+        ( offset, length ) = spec[ i ][ : 2 ]
+        mask = _length_to_mask( length )
+        if keyed == True:
+            key = '_k%d' % i
+            names[ key ] = spec[ i ][ 2 ]
+            value = 'values[ %s ]' % key
+        else:
+            value = 'values[ %d ]' % i
+        packs.append( '( ( %s & 0x%X ) << %d )' % ( value, mask, offset ) )
+        extract = '( ( data >> %d ) & 0x%X )' % ( offset, mask )
+        if keyed == True:
+            unpacks.append( '%s : %s' % ( key, extract ) )
+        else:
+            unpacks.append( extract )
+    if keyed == True:
+        result = '{ %s }' % ', '.join( unpacks )
+    else:
+        result = '[ %s ]' % ', '.join( unpacks )
+    source = 'def pack( values ):\n    return %s\n' \
+        'def unpack( data ):\n    return %s\n' % (
+        ' | '.join( packs ) if len( packs ) > 0 else '0',
+        result
+    )
+    exec( source, names )
+    return ( names[ 'pack' ], names[ 'unpack' ] )
+
+
 #=============================================================================
 def _get_mask( offset, length ):
     return _length_to_mask( length ) << offset
@@ -154,10 +557,7 @@ def _get_mask( offset, length ):
 
 #=============================================================================
 def _length_to_mask( length ):
-    mask = 0
-    for position in range( length ):
-        mask |= ( 1 << position )
-    return mask
+    return ( 1 << length ) - 1
 
 
 #=============================================================================
@@ -226,6 +626,16 @@ def main( argv ):
         else:
             print 'Re-packed data matches original: FAILED'
 
+    # test unpacking/packing arrays of words
+    data   = '\xEF\xBE\x00\xA5\x0D\x0E\x0F\x10'
+    values = unpack_array( example, data, 2, '>' )
+    print '== Array Test Case =='
+    print 'Unpack: ', values
+    if pack_array( example, values, 2, '>' ) == data:
+        print 'Re-packed array matches original: PASSED'
+    else:
+        print 'Re-packed array matches original: FAILED'
+
     # Return success.
     return 0
 
@@ -8,8 +8,19 @@ HTTP helper class for typical use cases.
 
 import BaseHTTPServer
 import cookielib
+import errno
+import hashlib
+import httplib
 import json
+import os
+import re
+import socket
+import tempfile
+import threading
+import time
+import urllib
 import urllib2
+import zlib
 
 
 __version__ = '0.0.0'
@@ -18,6 +29,24 @@ __version__ = '0.0.0'
 # set a module variable to the dict of HTTP response code strings
 _http_codes = BaseHTTPServer.BaseHTTPRequestHandler.responses
 
+# client shared by the convenience functions
+_default_client = None
+
+# number of bytes read from a response at a time when streaming
+_fetch_chunk = 65536
+
+# request methods that are safe to send again on a new connection
+_idempotent = ( 'GET', 'HEAD' )
+
+# content encodings accepted (and decoded) for JSON requests
+_accept_encoding = { 'Accept-Encoding' : 'gzip, deflate' }
+
+# patterns used to scan streaming JSON documents
+_json_scalar_end = re.compile( r'[\s,\]}]' )
+_json_space      = re.compile( r'\S' )
+_json_special    = re.compile( r'["\\]' )
+_json_structure  = re.compile( r'[\[\]{}"]' )
+
 
 #=============================================================================
 class http_error( Exception ):
@@ -28,13 +57,706 @@ class http_error( Exception ):
     a meaningful message), and present a single string in an attempt to help
     the user find a solution.
     """
-    pass
+
+
+    #=========================================================================
+    def __init__( self, message, code = None, headers = None ):
+        """
+        Initializes an http_error object.
+        @param message The error message
+        @param code The HTTP response status code (if the host responded)
+        @param headers The HTTP response headers (if the host responded)
+        """
+        super( http_error, self ).__init__( message )
+        self.code    = code
+        self.headers = headers
+
+
+#=============================================================================
+class _response_cache( object ):
+    """
+    On-disk cache of response bodies and their validators (ETag and
+    Last-Modified).  Each URL is stored as a single file named by the hash
+    of the URL: a line of JSON metadata followed by the body.  Keeping both
+    in one file means a reader never pairs one response's validators with
+    another response's body.
+    """
+
+
+    #=========================================================================
+    def __init__( self, path, max_age = None ):
+        """
+        Initializes a response cache.
+        @param path Path to the cache directory (created if necessary)
+        @param max_age Number of seconds a response is fresh when the host
+                       does not send a max-age (default: always revalidate)
+        """
+        self.path    = path
+        self.max_age = max_age
+        if not os.path.isdir( path ):
+            os.makedirs( path )
+
+
+    #=========================================================================
+    def load( self, url ):
+        """
+        Loads the cache entry for a URL.
+        @param url The URL of the cached response
+        @return A dictionary describing the cached response, or None
+        """
+        try:
+            with open( self._get_name( url ), 'rb' ) as handle:
+                entry = json.loads( handle.readline() )
+                entry[ 'body' ] = handle.read()
+        except ( IOError, ValueError ):
+            return None
+        if entry.get( 'url' ) != url:
+            return None
+        return entry
+
+
+    #=========================================================================
+    def refresh( self, entry, info ):
+        """
+        Updates a cache entry's lifetime (and any validators the host
+        updated) after the host confirms the cached response is still valid
+        (304 Not Modified).
+        @param entry The cache entry (see load())
+        @param info The 304 response's headers
+        """
+        entry[ 'expires' ] = self._get_expires( info )
+        if info.get( 'etag' ) is not None:
+            entry[ 'etag' ] = info.get( 'etag' )
+        if info.get( 'last-modified' ) is not None:
+            entry[ 'modified' ] = info.get( 'last-modified' )
+        self._write( entry[ 'url' ], entry, entry[ 'body' ] )
+
+
+    #=========================================================================
+    def store( self, url, info, ctype, body ):
+        """
+        Stores a response in the cache (unless the host forbids it).
+        @param url The URL of the response
+        @param info The response headers
+        @param ctype The response's content type
+        @param body The response body
+        """
+        control = info.get( 'cache-control', '' ).lower()
+        if 'no-store' in control:
+            return
+        entry = {
+            'url'      : url,
+            'ctype'    : ctype,
+            'etag'     : info.get( 'etag' ),
+            'modified' : info.get( 'last-modified' ),
+            'expires'  : self._get_expires( info )
+        }
+        if ( entry[ 'etag' ] is None ) and ( entry[ 'modified' ] is None ) \
+            and ( entry[ 'expires' ] <= time.time() ):
+            return
+        self._write( url, entry, body )
+
+
+    #=========================================================================
+    @staticmethod
+    def is_fresh( entry ):
+        """
+        Checks if a cached response can be used without asking the host.
+        """
+        return time.time() < entry[ 'expires' ]
+
+
+    #=========================================================================
+    @staticmethod
+    def get_validators( entry ):
+        """
+        Gets the conditional request headers for revalidating a response.
+        """
+        headers = {}
+        if entry[ 'etag' ] is not None:
+            headers[ 'If-None-Match' ] = entry[ 'etag' ]
+        if entry[ 'modified' ] is not None:
+            headers[ 'If-Modified-Since' ] = entry[ 'modified' ]
+        return headers
+
+
+    #=========================================================================
+    def _get_expires( self, info ):
+        control = info.get( 'cache-control', '' ).lower()
+        if 'no-cache' in control:
+            return 0.0
+        match = re.search( r'max-age\s*=\s*"?(\d+)', control )
+        if match is not None:
+            return time.time() + int( match.group( 1 ) )
+        if self.max_age is not None:
+            return time.time() + self.max_age
+        return 0.0
+
+
+    #=========================================================================
+    def _get_name( self, url ):
+        return os.path.join( self.path, hashlib.sha1( url ).hexdigest() )
+
+
+    #=========================================================================
+    def _write( self, url, entry, body ):
+        """
+        Writes a cache entry's file (written to a temporary file, then
+        renamed, so concurrent readers never see a partial entry).
+        """
+        name = self._get_name( url )
+        meta = dict( ( k, v ) for k, v in entry.items() if k != 'body' )
+        ( fd, temp ) = tempfile.mkstemp( dir = self.path )
+        with os.fdopen( fd, 'wb' ) as handle:
+            handle.write( json.dumps( meta ) + '\n' )
+            handle.write( body )
+        if os.name == 'nt' and os.path.exists( name ):
+            os.remove( name )
+        os.rename( temp, name )
+
+
+#=============================================================================
+class _connection_pool( object ):
+    """
+    Pool of idle, persistent HTTP/1.1 connections, kept for each host.
+    """
+
+
+    #=========================================================================
+    def __init__( self, size = 4, idle = 60.0 ):
+        """
+        Initializes a connection pool.
+        @param size Maximum number of idle connections kept for each host
+        @param idle Number of seconds an idle connection is kept
+        """
+        self.size   = size
+        self.idle   = idle
+        self._lock  = threading.Lock()
+        self._hosts = {}
+
+
+    #=========================================================================
+    def close( self ):
+        """
+        Closes all idle connections.
+        """
+        with self._lock:
+            hosts       = self._hosts
+            self._hosts = {}
+        for idle in hosts.values():
+            for connection, stamp in idle:
+                connection.close()
+
+
+    #=========================================================================
+    def get( self, key ):
+        """
+        Retrieves an idle connection for a host.
+        @param key The host's pool key
+        @return An idle connection, or None if the host has none
+        """
+        expired    = []
+        connection = None
+        with self._lock:
+            idle = self._hosts.get( key, [] )
+            now  = time.time()
+            while len( idle ) > 0:
+                ( candidate, stamp ) = idle.pop()
+                if ( now - stamp ) < self.idle:
+                    connection = candidate
+                    break
+                expired.append( candidate )
+        for candidate in expired:
+            candidate.close()
+        return connection
+
+
+    #=========================================================================
+    def put( self, key, connection ):
+        """
+        Returns a connection to the pool once its response is complete.
+        @param key The host's pool key
+        @param connection The idle connection
+        """
+        with self._lock:
+            idle = self._hosts.setdefault( key, [] )
+            if len( idle ) < self.size:
+                idle.append( ( connection, time.time() ) )
+                return
+        connection.close()
+
+
+    #=========================================================================
+    def resize( self, size ):
+        """
+        Changes the number of idle connections kept for each host.  The
+        oldest idle connections beyond the new size are closed.
+        @param size Maximum number of idle connections kept for each host
+        """
+        extra = []
+        with self._lock:
+            self.size = size
+            for idle in self._hosts.values():
+                if len( idle ) > size:
+                    extra.extend( idle[ : ( len( idle ) - size ) ] )
+                    del idle[ : ( len( idle ) - size ) ]
+        for connection, stamp in extra:
+            connection.close()
+
+
+#=============================================================================
+class _pooled_socket( object ):
+    """
+    Adapts a response on a pooled connection to the socket interface used by
+    socket._fileobject (like urllib2 does).  The connection is returned to
+    the pool once the response body has been completely read, or closed if
+    the response is abandoned.
+    """
+
+
+    #=========================================================================
+    def __init__( self, pool, key, connection, response ):
+        self._connection = connection
+        self._key        = key
+        self._pool       = pool
+        self._response   = response
+        if response.length == 0:
+            response.read()
+            self._release()
+
+
+    #=========================================================================
+    def close( self ):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+    #=========================================================================
+    def recv( self, size ):
+        data = self._response.read( size )
+        if self._response.isclosed() == True:
+            self._release()
+        return data
+
+
+    #=========================================================================
+    def _release( self ):
+        if self._connection is not None:
+            if self._response.will_close:
+                self._connection.close()
+            else:
+                self._pool.put( self._key, self._connection )
+            self._connection = None
+
+
+#=============================================================================
+class _pool_handler( urllib2.HTTPHandler, urllib2.HTTPSHandler ):
+    """
+    Replaces urllib2's HTTP and HTTPS handlers (which close the connection
+    after every request) with handlers that reuse pooled connections.
+    Proxied requests are pooled by proxy (and tunnel) host.
+    """
+
+
+    #=========================================================================
+    def __init__( self, pool, context = None ):
+        urllib2.HTTPSHandler.__init__( self, context = context )
+        self.pool = pool
+
+
+    #=========================================================================
+    def http_open( self, request ):
+        return self._open( httplib.HTTPConnection, request )
+
+
+    #=========================================================================
+    def https_open( self, request ):
+        return self._open(
+            httplib.HTTPSConnection, request, context = self._context
+        )
+
+
+    #=========================================================================
+    def _open( self, connection_class, request, **kwargs ):
+        """
+        Sends a request on a pooled connection (or a new connection).
+        """
+
+        host = request.get_host()
+        if not host:
+            raise urllib2.URLError( 'no host given' )
+        key = ( connection_class.__name__, host, request._tunnel_host )
+
+        # request headers (see urllib2.AbstractHTTPHandler.do_open)
+        headers = dict( request.unredirected_hdrs )
+        headers.update( dict(
+            ( k, v ) for k, v in request.headers.items() if k not in headers
+        ) )
+        headers = dict(
+            ( name.title(), value ) for name, value in headers.items()
+        )
+        tunnel  = {}
+        if 'Proxy-Authorization' in headers:
+            if request._tunnel_host:
+                tunnel[ 'Proxy-Authorization' ] = headers.pop(
+                    'Proxy-Authorization'
+                )
+
+        # try an idle connection first, then a new connection (an idle
+        # connection may have been closed by the host).  Only idempotent
+        # requests are retried, since the host may have seen the request.
+        retry = request.get_method() in _idempotent
+        while True:
+            connection = self.pool.get( key )
+            reused     = connection is not None
+            if reused == False:
+                connection = connection_class(
+                    host,
+                    timeout = request.timeout,
+                    **kwargs
+                )
+                if request._tunnel_host:
+                    connection.set_tunnel(
+                        request._tunnel_host,
+                        headers = tunnel
+                    )
+            try:
+                connection.request(
+                    request.get_method(),
+                    request.get_selector(),
+                    request.data,
+                    headers
+                )
+                response = connection.getresponse( buffering = True )
+                break
+            except ( httplib.HTTPException, socket.error ) as error:
+                connection.close()
+                if ( reused == False ) or ( retry == False ) \
+                    or ( _is_stale( error ) == False ):
+                    raise urllib2.URLError( error )
+
+        # wrap the response like urllib2 does
+        sock = _pooled_socket( self.pool, key, connection, response )
+        fp   = socket._fileobject( sock, close = True )
+        result      = urllib.addinfourl(
+            fp,
+            response.msg,
+            request.get_full_url()
+        )
+        result.code = response.status
+        result.msg  = response.reason
+        return result
+
+
+#=============================================================================
+class _decoded_response( object ):
+    """
+    Decodes a compressed (gzip or deflate Content-Encoding) response while it
+    is being read.  Each step decompresses at most one read chunk of output,
+    so a small compressed chunk can not expand into a large buffer.
+    """
+
+
+    #=========================================================================
+    def __init__( self, response ):
+        self._buffer   = ''
+        self._decoder  = None
+        self._done     = False
+        self._empty    = True
+        self._encoded  = True
+        self._head     = ''
+        self._response = response
+        self._tail     = ''
+        encoding = response.info().get( 'content-encoding', 'identity' )
+        encoding = encoding.strip().lower()
+        if encoding in ( 'gzip', 'x-gzip' ):
+            self._decoder = zlib.decompressobj( 16 + zlib.MAX_WBITS )
+        elif encoding == 'identity':
+            self._encoded = False
+        elif encoding != 'deflate':
+            raise http_error( 'Unsupported Content-Encoding: %s' % encoding )
+
+
+    #=========================================================================
+    def read( self, size = -1 ):
+        """
+        Reads decoded response data.
+        @param size Maximum number of bytes to read (default: all)
+        @return Decoded response data (empty at the end of the response)
+        """
+
+        # uncompressed responses are read directly
+        if self._encoded == False:
+            if size < 0:
+                return self._response.read()
+            return self._response.read( size )
+
+        # collect decoded chunks until there is enough data (joined once)
+        chunks = [ self._buffer ]
+        count  = len( self._buffer )
+        while ( self._done == False ) and ( ( size < 0 ) or ( count < size ) ):
+
+            # finish decompressing the last chunk before reading another
+            if len( self._tail ) > 0:
+                data = self._decode( '' )
+            else:
+                data = self._response.read( _fetch_chunk )
+                if len( data ) == 0:
+                    data = self._flush()
+                    self._done = True
+                else:
+                    data = self._decode( data )
+            chunks.append( data )
+            count += len( data )
+
+        data = ''.join( chunks )
+        if size < 0:
+            size = len( data )
+        self._buffer = data[ size : ]
+        return data[ : size ]
+
+
+    #=========================================================================
+    def _decode( self, data ):
+        self._empty = self._empty and ( len( data ) == 0 )
+
+        # some hosts send raw deflate data without the zlib header, so wait
+        # for the two header bytes before selecting the decoder
+        if self._decoder is None:
+            self._head += data
+            if len( self._head ) < 2:
+                return ''
+            ( data, self._head ) = ( self._head, '' )
+            self._decoder = zlib.decompressobj(
+                zlib.MAX_WBITS if _is_zlib_header( data ) else -zlib.MAX_WBITS
+            )
+
+        try:
+            result = self._decoder.decompress( self._tail + data, _fetch_chunk )
+        except zlib.error:
+            raise http_error( 'Invalid compressed response.' )
+        self._tail = self._decoder.unconsumed_tail
+        return result
+
+
+    #=========================================================================
+    def _flush( self ):
+        """
+        Finishes decoding at the end of the response, and checks that the
+        compressed data ended exactly at the end of the response.
+        """
+
+        # an empty response has nothing to decode
+        if self._empty == True:
+            return ''
+        if self._decoder is None:
+            raise http_error( 'Truncated compressed response.' )
+
+        # once the compressed data has ended, any more data is left unused,
+        # so a probe byte shows whether the end was reached (without any
+        # other data following it)
+        try:
+            result = self._decoder.decompress( '\0' ) + self._decoder.flush()
+        except zlib.error:
+            raise http_error( 'Invalid compressed response.' )
+        if self._decoder.unused_data != '\0':
+            if len( self._decoder.unused_data ) == 0:
+                raise http_error( 'Truncated compressed response.' )
+            raise http_error( 'Invalid compressed response.' )
+        return result
+
+
+#=============================================================================
+class _json_scanner( object ):
+    """
+    Scans a JSON document as it is read, and extracts the elements of an
+    array one at a time.  Only the current element (and one chunk of the
+    document) is kept in memory.
+    """
+
+
+    #=========================================================================
+    def __init__( self, read ):
+        """
+        Initializes a JSON scanner.
+        @param read Function that reads the next chunk of the document
+        """
+        self._buffer = ''
+        self._pos    = 0
+        self._read   = read
+
+
+    #=========================================================================
+    def iter_items( self, path ):
+        """
+        Iterates over the elements of an array in the document.
+        @param path Dot-separated keys (or array indices) leading to the
+                    array in the document (empty for a top-level array)
+        @return Iterator of the array's elements
+        @throws ValueError if the document does not match the path
+        """
+
+        # follow the path to the array
+        for key in [ k for k in path.split( '.' ) if len( k ) > 0 ]:
+            if self._peek() == '[' and key.isdigit():
+                self._expect( '[' )
+                for index in range( int( key ) ):
+                    self._skip_value()
+                    self._expect( ',' )
+                continue
+            self._expect( '{' )
+            while True:
+                if self._peek() != '"':
+                    raise ValueError( 'JSON key not found: %s' % key )
+                name = json.loads( self._value() )
+                self._expect( ':' )
+                if name == key:
+                    break
+                self._skip_value()
+                if self._expect( ',}' ) == '}':
+                    raise ValueError( 'JSON key not found: %s' % key )
+
+        # parse each element of the array
+        self._expect( '[' )
+        if self._peek() == ']':
+            return
+        while True:
+            yield json.loads( self._value() )
+            self._compact()
+            if self._expect( ',]' ) == ']':
+                return
+
+
+    #=========================================================================
+    def _compact( self ):
+        if self._pos >= _fetch_chunk:
+            self._buffer = self._buffer[ self._pos : ]
+            self._pos    = 0
+
+
+    #=========================================================================
+    def _expect( self, chars ):
+        char = self._peek()
+        if ( char is None ) or ( char not in chars ):
+            raise ValueError(
+                'Expected %s in JSON document (found %r).' % ( chars, char )
+            )
+        self._pos += 1
+        return char
+
+
+    #=========================================================================
+    def _more( self ):
+        # read at least as much as is buffered, so a large value grows the
+        # buffer geometrically (copying each byte a bounded number of times)
+        data = self._read( max( _fetch_chunk, len( self._buffer ) ) )
+        if len( data ) == 0:
+            return False
+        self._buffer += data
+        return True
+
+
+    #=========================================================================
+    def _peek( self ):
+        """
+        Skips whitespace, and returns the next character (None at the end of
+        the document).
+        """
+        while True:
+            match = _json_space.search( self._buffer, self._pos )
+            if match is not None:
+                self._pos = match.start()
+                return self._buffer[ self._pos ]
+            self._pos = len( self._buffer )
+            if self._more() == False:
+                return None
+
+
+    #=========================================================================
+    def _search( self, pattern, pos ):
+        """
+        Searches for a pattern, reading more of the document as needed.
+        """
+        while True:
+            match = pattern.search( self._buffer, pos )
+            if match is not None:
+                return match
+            pos = len( self._buffer )
+            if self._more() == False:
+                return None
+
+
+    #=========================================================================
+    def _skip_value( self ):
+        self._value()
+        self._compact()
+
+
+    #=========================================================================
+    def _string_end( self, pos ):
+        pos += 1
+        while True:
+            match = self._search( _json_special, pos )
+            if match is None:
+                raise ValueError( 'Unterminated string in JSON document.' )
+            if match.group() == '"':
+                return match.end()
+            while len( self._buffer ) <= match.end():
+                if self._more() == False:
+                    raise ValueError( 'Unterminated string in JSON document.' )
+            pos = match.end() + 1
+
+
+    #=========================================================================
+    def _value( self ):
+        """
+        Finds the text of the next complete value in the document.
+        """
+        char  = self._peek()
+        start = self._pos
+        if char is None:
+            raise ValueError( 'Unexpected end of JSON document.' )
+
+        # strings
+        if char == '"':
+            end = self._string_end( start )
+
+        # numbers, true, false, null
+        elif char not in '[{':
+            match = self._search( _json_scalar_end, start )
+            end   = len( self._buffer ) if match is None else match.start()
+
+        # objects and arrays
+        else:
+            depth = 0
+            pos   = start
+            while True:
+                match = self._search( _json_structure, pos )
+                if match is None:
+                    raise ValueError( 'Unexpected end of JSON document.' )
+                char = match.group()
+                if char == '"':
+                    pos = self._string_end( match.start() )
+                    continue
+                pos = match.end()
+                if char in '[{':
+                    depth += 1
+                else:
+                    depth -= 1
+                    if depth == 0:
+                        break
+            end = pos
+
+        self._pos = end
+        return self._buffer[ start : end ]
 
 
 #=============================================================================
 class http( object ):
     """
     Provides a simplified interface to fetching files and data over HTTP.
+    Connections to each host are kept open, and reused by later requests.
     """
 
 
@@ -56,6 +778,14 @@ class http( object ):
                           port  Proxy service port
                           user  Optional user name to send to proxy
                           pass  Optional password to send to proxy
+                        pool    Container dictionary for the following items:
+                          size  Idle connections kept for each host (4)
+                          idle  Seconds to keep idle connections (60)
+                        cache   Container dictionary for the following items:
+                          path  Directory for cached JSON responses
+                          max_age
+                                Seconds a response is fresh when the host
+                                does not say (default: always revalidate)
         """
 
         # store the config in object state
@@ -76,87 +806,250 @@ class http( object ):
         cproc = urllib2.HTTPCookieProcessor( cjar )
         self.handlers.append( cproc )
 
-        # build our custom opener and install it for future requests
-        opener = urllib2.build_opener( *self.handlers )
-        urllib2.install_opener( opener )
+        # keep persistent connections for each host
+        pc = self.config.get( 'pool', {} )
+        self.pool = _connection_pool(
+            size = pc.get( 'size', 4 ),
+            idle = pc.get( 'idle', 60.0 )
+        )
+        self.handlers.append( _pool_handler( self.pool ) )
+
+        # build our custom opener (used only by this object)
+        self.opener = urllib2.build_opener( *self.handlers )
+
+        # check for a response cache
+        self.cache = None
+        if 'cache' in self.config:
+            cc = self.config[ 'cache' ]
+            self.cache = _response_cache( cc[ 'path' ], cc.get( 'max_age' ) )
 
 
     #=========================================================================
-    def fetch( self, url, local ):
+    def close( self ):
+        """
+        Closes any idle connections kept for future requests.
+        """
+        self.pool.close()
+
+
+    #=========================================================================
+    def fetch( self, url, local, progress = None, resume = True ):
         """
         Requests a remote file over HTTP, and stores the response on the local
-        file system.
+        file system.  The response is streamed to a partial file (the local
+        path with a ".part" suffix), which is renamed once the download is
+        complete.  If a partial file exists from an earlier attempt, only
+        the rest of the file is requested (if the host supports ranges).
         @param url The URL of the remote file to download over HTTP
         @param local The path to the local destination file
-        @return The number of bytes written to the local file
+        @param progress Optional function called after each chunk is written
+                        with the number of bytes in the local file, and the
+                        total size of the file (None if unknown)
+        @param resume Set to continue a partial download
+        @return The number of bytes in the local file
         @throws http_error
         """
 
-        # attempt to open the local file for writing the contents of the fetch
+        partial = local + '.part'
+        offset  = 0
+        if ( resume == True ) and os.path.exists( partial ):
+            offset = os.path.getsize( partial )
+
+        # attempt to fetch the remote file (or the rest of it)
+        response = None
+        if offset > 0:
+            try:
+                response = self._get_url(
+                    url,
+                    { 'Range' : 'bytes=%d-' % offset }
+                )
+            except http_error:
+                pass
+        if response is None:
+            response = self._get_url( url )
+
+        # the host only sends the requested range if it supports ranges
+        info = response.info()
+        if ( offset > 0 ) and ( response.code == 206 ):
+            start = _get_range_start( info.get( 'content-range', '' ) )
+            if start != offset:
+                raise http_error(
+                    'Host sent range starting at %s (expected %d).' % (
+                        start, offset
+                    )
+                )
+            mode = 'ab'
+        else:
+            offset = 0
+            mode   = 'wb'
+
+        # the total size of the file (if known)
+        total = None
+        if 'content-length' in info:
+            total = offset + int( info[ 'content-length' ] )
+
+        # attempt to open the partial file for writing the contents
         try:
-            handle = open( local, 'wb' )
+            handle = open( partial, mode )
         except IOError:
-            raise http_error( 'Unable to open %s.' % local )
+            raise http_error( 'Unable to open %s.' % partial )
+
+        # stream the contents of the remote file to the partial file
+        result = offset
+        try:
+            while True:
+                data = response.read( _fetch_chunk )
+                if len( data ) == 0:
+                    break
+                handle.write( data )
+                result += len( data )
+                if progress is not None:
+                    progress( result, total )
+        except ( IOError, httplib.HTTPException ) as e:
+            raise http_error(
+                'Transfer of %s interrupted at %d bytes (%s).' % (
+                    url, result, e
+                )
+            )
+        finally:
+            handle.close()
 
-        # attempt to fetch the remote file
-        response = self._get_url( url )
+        # check the length of the file against the header's value
+        if ( total is not None ) and ( result != total ):
+            raise http_error(
+                'Data written (%d) does not match data promised (%d).' % (
+                    result, total
+                )
+            )
 
-        # write the contents of the remote file to the local file
-        handle.write( response.read() )
+        # move the complete file into place
+        if os.path.exists( local ):
+            os.remove( local )
+        os.rename( partial, local )
 
-        # determine how many bytes were written
-        result = handle.tell()
+        # return the number of bytes in the local file
+        return result
 
-        # fetch the response headers
-        info = response.info()
 
-        # see if a Content-Length header was sent
-        if 'content-length' in info:
+    #=========================================================================
+    def fetch_many( self, url_to_path_map, concurrency = 8, progress = None ):
+        """
+        Downloads many remote files at the same time (see fetch()).  All
+        downloads share this object's cookies, proxy, and connections.  A
+        failed download does not stop the others.
+        @param url_to_path_map Dictionary of local file paths keyed by URL
+        @param concurrency Maximum number of downloads at the same time
+        @param progress Optional function called after each chunk is written
+                        with the URL, the number of bytes in the local file,
+                        and the total size of the file (None if unknown)
+        @return A tuple of two dictionaries keyed by URL: the number of bytes
+                in each downloaded file, and the error (exception) of each
+                failed download
+        @throws http_error if two URLs are downloaded to the same file
+        """
 
-            # check the length of the file against the header's value
-            length = int( info[ 'content-length' ] )
-            if result != length:
+        # downloads to the same file would write the same partial file
+        targets = {}
+        for url, local in url_to_path_map.items():
+            target = os.path.abspath( local )
+            if target in targets:
                 raise http_error(
-                    'Data written (%d) does not match data promised (%d).' % (
-                        result, length
-                    )
+                    'Both %s and %s would be downloaded to %s.'
+                    % ( targets[ target ], url, target )
                 )
+            targets[ target ] = url
 
-        # close the file
-        handle.close()
+        def fetch_one( url ):
+            report = None
+            if progress is not None:
+                report = lambda done, total: progress( url, done, total )
+            return self.fetch( url, url_to_path_map[ url ], report )
 
-        # return the number of bytes written
-        return result
+        return self._map( fetch_one, url_to_path_map.keys(), concurrency )
+
+
+    #=========================================================================
+    def get_json_many( self, urls, concurrency = 8 ):
+        """
+        Requests many JSON resources at the same time (see get_json()).
+        @param urls List of URLs of the JSON resources to request
+        @param concurrency Maximum number of requests at the same time
+        @return A tuple of two dictionaries keyed by URL: the data parsed
+                from each JSON document, and the error (exception) of each
+                failed request
+        """
+        return self._map( self.get_json, urls, concurrency )
 
 
     #=========================================================================
     def get_json( self, url ):
         """
         Requests a URL, receives the response, and parses the response as if
-        it were a JSON document.
+        it were a JSON document.  With a cache, fresh responses are loaded
+        from the cache, and stale responses are revalidated with the host.
         @param url The URL of the JSON resource to request
         @return An object containing the data parsed from the JSON document
         @throws http_error
         """
 
-        # attempt to fetch the JSON response from the host
-        response = self._get_url( url )
+        # attempt to fetch the JSON response from the host (or the cache)
+        ( ctype, body ) = self._get_cached( url )
 
         # make sure the host says it sent JSON data
-        if response.ctype[ 0 ] == 'application/json':
+        if ctype == 'application/json':
 
             # attempt to parse the response data into a native dict/list/etc
-            return json.loads( response.read() )
+            return json.loads( body )
 
         # host did not send the appropriate Content-Type header
         raise http_error(
             'Invalid Content-Type (%s) received for JSON request.\n%s' % (
-                response.ctype[ 0 ],
-                response.read()
+                ctype,
+                body
             )
         )
 
 
+    #=========================================================================
+    def iter_json_items( self, url, path = '' ):
+        """
+        Requests a URL, and parses the elements of an array in the JSON
+        response while the response is being received.  Large listings can
+        be processed without holding the entire document in memory.
+
+        Example:
+            for repo in client.iter_json_items( url, 'data.repos' ):
+                print repo[ 'name' ]
+
+        @param url The URL of the JSON resource to request
+        @param path Dot-separated keys (or array indices) leading to the
+                    array in the document (empty for a top-level array)
+        @return Iterator of the array's elements
+        @throws http_error
+        """
+
+        # attempt to fetch the JSON response from the host
+        response = self._get_url( url, _accept_encoding )
+        decoded  = _decoded_response( response )
+
+        # make sure the host says it sent JSON data
+        if response.ctype[ 0 ] != 'application/json':
+            raise http_error(
+                'Invalid Content-Type (%s) received for JSON request.\n%s' % (
+                    response.ctype[ 0 ],
+                    decoded.read()
+                )
+            )
+
+        # parse each array element as soon as it is received
+        scanner = _json_scanner( decoded.read )
+        try:
+            for item in scanner.iter_items( path ):
+                yield item
+        except ValueError as e:
+            raise http_error( 'Invalid JSON response: %s' % e )
+
+
     #=========================================================================
     def post_json( self, url, data ):
         """
@@ -175,18 +1068,19 @@ class http( object ):
             body     = json.dumps( data ),
             mimetype = 'application/json'
         )
+        body = _decoded_response( response ).read()
 
         # make sure the host says it sent JSON data
         if response.ctype[ 0 ] == 'application/json':
 
             # attempt to parse the response data into a native dict/list/etc
-            return json.loads( response.read() )
+            return json.loads( body )
 
         # host did not send the appropriate Content-Type header
         raise http_error(
             'Invalid Content-Type (%s) received for JSON request.\n%s' % (
                 response.ctype[ 0 ],
-                response.read()
+                body
             )
         )
 
@@ -215,7 +1109,7 @@ class http( object ):
                 auth = ''
             self.proxy = {
                 pc[ 'type' ] :
-                    'http://%s%s:%d' % ( auth, pc['host'], pc['port'] )
+                    'http://%s%s:%s' % ( auth, pc['host'], pc['port'] )
             }
             proxy = urllib2.ProxyHandler( self.proxy )
             self.handlers.append( proxy )
@@ -241,23 +1135,119 @@ class http( object ):
 
 
     #=========================================================================
-    def _get_url( self, url ):
+    def _get_cached( self, url ):
+        """
+        Perform a GET request for the given URL, using the cache if enabled.
+        @param url URL of the resource to request
+        @return A tuple of the response's content type and body
+        @throws http_error
+        """
+
+        # no cache
+        if self.cache is None:
+            response = self._get_url( url, _accept_encoding )
+            return (
+                response.ctype[ 0 ],
+                _decoded_response( response ).read()
+            )
+
+        # use fresh responses without asking the host
+        entry = self.cache.load( url )
+        if ( entry is not None ) and self.cache.is_fresh( entry ):
+            return ( entry[ 'ctype' ], entry[ 'body' ] )
+
+        # ask the host for the response, or confirmation the cached response
+        # has not been modified
+        headers = dict( _accept_encoding )
+        if entry is not None:
+            headers.update( self.cache.get_validators( entry ) )
+        try:
+            response = self._get_url( url, headers )
+        except http_error as e:
+            if ( e.code == 304 ) and ( entry is not None ):
+                self.cache.refresh( entry, e.headers )
+                return ( entry[ 'ctype' ], entry[ 'body' ] )
+            raise
+
+        body = _decoded_response( response ).read()
+        if response.code == 200:
+            self.cache.store( url, response.info(), response.ctype[ 0 ], body )
+        return ( response.ctype[ 0 ], body )
+
+
+    #=========================================================================
+    def _get_url( self, url, headers = None ):
         """
         Perform a GET request for the given URL, and return a response object.
+        @param url URL of the resource to request
+        @param headers Optional dictionary of additional request headers
         """
-        request = urllib2.Request( url )
+        request = urllib2.Request( url, headers = headers or {} )
         try:
-            response = urllib2.urlopen( request )
+            response = self.opener.open( request )
         except urllib2.HTTPError as e:
             raise http_error(
-                'Error: %d; %s' % ( e.code, _http_codes[ e.code ][ 0 ] )
+                'Error: %d; %s' % ( e.code, _http_codes[ e.code ][ 0 ] ),
+                e.code,
+                e.info()
             )
         except urllib2.URLError as e:
-            raise http_error( 'Error: %d; %s' % e.reason )
+            raise http_error( 'Error: %s' % ( e.reason, ) )
         self._decorate_response( response )
         return response
 
 
+    #=========================================================================
+    def _map( self, function, urls, concurrency ):
+        """
+        Calls a function for each URL using a bounded number of threads.
+        @return A tuple of two dictionaries keyed by URL: the result of each
+                successful call, and the exception raised by each failed call
+        """
+
+        urls    = list( urls )
+        lock    = threading.Lock()
+        queue   = iter( urls )
+        results = {}
+        errors  = {}
+
+        # keep enough idle connections for every thread (only while the
+        # threads are running)
+        size = self.pool.size
+        self.pool.resize( max( size, concurrency ) )
+
+        def worker():
+            while True:
+                with lock:
+                    try:
+                        url = next( queue )
+                    except StopIteration:
+                        return
+                try:
+                    result = function( url )
+                except Exception as e:
+                    with lock:
+                        errors[ url ] = e
+                else:
+                    with lock:
+                        results[ url ] = result
+
+        threads = [
+            threading.Thread( target = worker )
+            for i in range( max( 1, min( concurrency, len( urls ) ) ) )
+        ]
+        try:
+            for thread in threads:
+                thread.daemon = True
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            self.pool.resize( size )
+
+        return ( results, errors )
+
+
     #=========================================================================
     def _post_url( self, url, body, mimetype = None ):
         """
@@ -281,19 +1271,21 @@ class http( object ):
             mimetype = 'application/x-www-form-urlencoded'
 
         # set up the request
-        request = urllib2.Request(
-            url, body, { 'Content-Type' : mimetype }
-        )
+        headers = dict( _accept_encoding )
+        headers[ 'Content-Type' ] = mimetype
+        request = urllib2.Request( url, body, headers )
 
         # send the request, fetch the response
         try:
-            response = urllib2.urlopen( request )
+            response = self.opener.open( request )
         except urllib2.HTTPError as e:
             raise http_error(
-                'Error: %d; %s' % ( e.code, _http_codes[ e.code ][ 0 ] )
+                'Error: %d; %s' % ( e.code, _http_codes[ e.code ][ 0 ] ),
+                e.code,
+                e.info()
             )
         except urllib2.URLError as e:
-            raise http_error( 'Error: %d; %s' % e.reason )
+            raise http_error( 'Error: %s' % ( e.reason, ) )
 
         # return the response object
         self._decorate_response( response )
@@ -301,19 +1293,87 @@ class http( object ):
 
 
 #=============================================================================
-def fetch( url, local, config = None ):
+def _get_range_start( content_range ):
+    """
+    Gets the first byte position from a Content-Range header value.
+    """
+    match = re.match( r'\s*bytes\s+(\d+)-', content_range )
+    if match is None:
+        return None
+    return int( match.group( 1 ) )
+
+
+#=============================================================================
+def _is_zlib_header( data ):
+    """
+    Check if data starts with a zlib stream header (deflate method, and a
+    header checksum that is a multiple of 31).
+    """
+    ( cmf, flg ) = ( ord( data[ 0 ] ), ord( data[ 1 ] ) )
+    return ( ( cmf & 0x0F ) == 8 ) and ( ( ( cmf << 8 ) | flg ) % 31 == 0 )
+
+
+#=============================================================================
+def _is_stale( error ):
+    """
+    Check if a request failed because the host closed an idle connection
+    (before sending any of the response).
+    """
+    if isinstance( error, httplib.BadStatusLine ):
+        return True
+    if isinstance( error, socket.timeout ):
+        return False
+    if isinstance( error, socket.error ):
+        return error.errno in ( errno.ECONNRESET, errno.EPIPE )
+    return False
+
+
+#=============================================================================
+def _get_client( config ):
+    """
+    Gets an HTTP client for the convenience functions.  Without a config,
+    one client (and its connections) is shared by every call.
+    """
+    global _default_client
+    if config is not None:
+        return http( config )
+    if _default_client is None:
+        _default_client = http()
+    return _default_client
+
+
+#=============================================================================
+def fetch( url, local, config = None, progress = None ):
     """
     Provides a convenience function for simple file downloading.
     @param url The URL of the remote file to download over HTTP
     @param config Optional HTTP client config (see: http.__init__ docstring)
     @param local The path to the local destination file
+    @param progress Optional progress function (see: http.fetch docstring)
     """
 
-    # create a basic HTTP client
-    client = http( config )
+    # get a basic HTTP client
+    client = _get_client( config )
 
     # request the file, and attempt to store locally
-    client.fetch( url, local )
+    client.fetch( url, local, progress )
+
+
+#=============================================================================
+def fetch_many( url_to_path_map, concurrency = 8, config = None ):
+    """
+    Provides a convenience function for downloading many files at once.
+    @param url_to_path_map Dictionary of local file paths keyed by URL
+    @param concurrency Maximum number of downloads at the same time
+    @param config Optional HTTP client config (see: http.__init__ docstring)
+    @return A tuple of the results and errors (see: http.fetch_many)
+    """
+
+    # get a basic HTTP client
+    client = _get_client( config )
+
+    # request the files, and attempt to store them locally
+    return client.fetch_many( url_to_path_map, concurrency )
 
 
 #=============================================================================
@@ -325,13 +1385,47 @@ def get_json( url, config = None ):
     @return An object containing the data parsed from the JSON document
     """
 
-    # create a basic HTTP client
-    client = http( config )
+    # get a basic HTTP client
+    client = _get_client( config )
 
     # request the JSON document, and return the result
     return client.get_json( url )
 
 
+#=============================================================================
+def get_json_many( urls, concurrency = 8, config = None ):
+    """
+    Provides a convenience function for requesting many JSON documents.
+    @param urls List of URLs of the JSON resources to request
+    @param concurrency Maximum number of requests at the same time
+    @param config Optional HTTP client config (see: http.__init__ docstring)
+    @return A tuple of the results and errors (see: http.get_json_many)
+    """
+
+    # get a basic HTTP client
+    client = _get_client( config )
+
+    # request the JSON documents, and return the results
+    return client.get_json_many( urls, concurrency )
+
+
+#=============================================================================
+def iter_json_items( url, path = '', config = None ):
+    """
+    Provides a convenience function for streaming a JSON array.
+    @param url The URL of the JSON resource to request
+    @param path Path to the array in the document (see: http.iter_json_items)
+    @param config Optional HTTP client config (see: http.__init__ docstring)
+    @return Iterator of the array's elements
+    """
+
+    # get a basic HTTP client
+    client = _get_client( config )
+
+    # request the JSON document, and iterate over the array's elements
+    return client.iter_json_items( url, path )
+
+
 #=============================================================================
 def post_json( url, data, config = None ):
     """
@@ -342,8 +1436,8 @@ def post_json( url, data, config = None ):
     @return An object containing the data parsed from the JSON document
     """
 
-    # create a basic HTTP client
-    client = http( config )
+    # get a basic HTTP client
+    client = _get_client( config )
 
     # request the JSON document, and return the result
     return client.post_json( url, data )
@@ -5,9 +5,39 @@
 ##############################################################################
 
 
+import copy
+import ctypes
+import mmap
+import os
+import re
 import struct
 
 
+# number of records to read from a file at a time
+_records_per_read = 4096
+
+# ctypes equivalents of struct format characters (native, standard sizes)
+_ctypes_map = {
+    'c' : ( ctypes.c_char,      ctypes.c_char     ),
+    'b' : ( ctypes.c_byte,      ctypes.c_int8     ),
+    'B' : ( ctypes.c_ubyte,     ctypes.c_uint8    ),
+    '?' : ( ctypes.c_bool,      ctypes.c_bool     ),
+    'h' : ( ctypes.c_short,     ctypes.c_int16    ),
+    'H' : ( ctypes.c_ushort,    ctypes.c_uint16   ),
+    'i' : ( ctypes.c_int,       ctypes.c_int32    ),
+    'I' : ( ctypes.c_uint,      ctypes.c_uint32   ),
+    'l' : ( ctypes.c_long,      ctypes.c_int32    ),
+    'L' : ( ctypes.c_ulong,     ctypes.c_uint32   ),
+    'q' : ( ctypes.c_longlong,  ctypes.c_int64    ),
+    'Q' : ( ctypes.c_ulonglong, ctypes.c_uint64   ),
+    'n' : ( ctypes.c_ssize_t,   None              ),
+    'N' : ( ctypes.c_size_t,    None              ),
+    'f' : ( ctypes.c_float,     ctypes.c_float    ),
+    'd' : ( ctypes.c_double,    ctypes.c_double   ),
+    'P' : ( ctypes.c_void_p,    None              )
+}
+
+
 #=============================================================================
 class structure:
     """
@@ -26,7 +56,20 @@ class structure:
 
         self.format = format
         self.fields = fields
-        self.sizeof = struct.calcsize( format )
+        self.struct = struct.Struct( format )
+        self.sizeof = self.struct.size
+
+        # Name every unpacked value (unnamed values get generated names)
+        count = len( self.struct.unpack( bytearray( self.sizeof ) ) )
+        self.names = [
+            fields[ i ]
+            if ( len( fields ) > i ) and ( fields[ i ] is not None )
+            else '_anon_%d' % i
+            for i in range( count )
+        ]
+
+        # ctypes class for zero-copy views (generated when first needed)
+        self._ctype = None
 
 
     #=========================================================================
@@ -42,36 +85,156 @@ class structure:
         if ( data is None ) or ( len( data ) != self.sizeof ):
             return False
 
-        # Unpack the data string into primitive types
-        parts = struct.unpack( self.format, data )
+        # Unpack the data string into the object
+        self._load_parts( obj, self.struct.unpack( data ) )
+
+        # Data properly loaded
+        return True
+
 
-        # Iterate over each parsed field
-        for i in range( len( parts ) ):
+    #=========================================================================
+    def load_from( self, obj, buffer, offset = 0 ):
+        """
+        Load parsed data into specified object from any position in a buffer
+        without slicing the buffer.
+        @param obj Dictionary (or object) to which data is loaded
+        @param buffer String, bytearray, memoryview, or mmap to read
+        @param offset Byte offset of the record in the buffer
+        @return True if successful
+        """
 
-            # The field name is specified
-            if ( len( self.fields ) > i ) and ( self.fields[ i ] is not None ):
+        # Ensure the buffer holds a complete record at the offset
+        if ( buffer is None ) or ( len( buffer ) < ( offset + self.sizeof ) ):
+            return False
+
+        # Unpack the record directly from the buffer into the object
+        self._load_parts( obj, self.struct.unpack_from( buffer, offset ) )
 
-                # Assign this data to the dictionary field
-                if type( obj ) is dict:
-                    obj[ self.fields[ i ] ] = parts[ i ]
+        # Data properly loaded
+        return True
 
-                # Assign this data to a member of the field's name
-                else:
-                    setattr( obj, self.fields[ i ], parts[ i ] )
 
-            # The field name is not specified
+    #=========================================================================
+    def iter_records( self, source, offset = 0 ):
+        """
+        Iterate over consecutive records in a buffer or file.  Records are
+        unpacked directly from the buffer (or from large blocks read from a
+        file) to avoid slicing and per-field handling.  Any trailing partial
+        record is ignored.
+        @param source String, bytearray, memoryview, mmap, or file handle
+        @param offset Byte offset of the first record
+        @return Iterator of tuples of record values (see names for the field
+                name of each value)
+        """
+
+        # Read files in blocks of many records
+        if hasattr( source, 'read' ) and not isinstance( source, mmap.mmap ):
+            return self._iter_file( source, offset )
+
+        # Determine the extent of the complete records in the buffer
+        count = ( len( source ) - offset ) // self.sizeof
+        end   = offset + ( count * self.sizeof )
+
+        # Use the bulk unpacker when it is available
+        if hasattr( self.struct, 'iter_unpack' ):
+            view = memoryview( source )[ offset : end ]
+            return self.struct.iter_unpack( view )
+
+        # Unpack each record in place
+        return (
+            self.struct.unpack_from( source, position )
+            for position in xrange( offset, end, self.sizeof )
+        )
+
+
+    #=========================================================================
+    def ctype( self, name = 'record' ):
+        """
+        Create a ctypes.Structure class with the same layout as the structure
+        format.  Each unpacked value becomes a member of the same name (see
+        names).  Pad bytes become members named "_pad_N".
+        @param name Name of the generated class
+        @return ctypes.Structure subclass
+        @throws ValueError if the format can not be represented by ctypes
+        """
+
+        # Select the byte order and alignment of the generated class
+        order = self.format[ : 1 ]
+        if order in ( '<', '>', '!', '=' ):
+            if order == '<':
+                base = ctypes.LittleEndianStructure
+            elif order in ( '>', '!' ):
+                base = ctypes.BigEndianStructure
             else:
+                base = ctypes.Structure
+            standard = 1
+        else:
+            base     = ctypes.Structure
+            standard = 0
 
-                # Assign this data to the dictionary field
-                if type( obj ) is dict:
-                    obj[ '_anon_%d' % i ] = parts[ i ]
+        # Build a member for each unpacked value.  The class is always
+        # packed, and native alignment is reproduced with explicit pad
+        # members (struct aligns native members, but never pads the end).
+        fields = []
+        offset = 0
+        names  = iter( self.names )
+        codes  = re.findall( r'(\d*)([^\s\d@=<>!])', self.format )
+        prefix = self.format[ : 1 ] if standard == 1 else '@'
+        for ( count, code ) in codes:
+            count = int( count ) if count else 1
+            ctype = _ctypes_map.get( code, ( None, None ) )[ standard ]
+            if ( standard == 0 ) and ( code not in 'xs' ):
+                start = struct.calcsize( prefix + code ) - struct.calcsize( code )
+                if start > offset:
+                    pad = '_pad_%d' % len( fields )
+                    fields.append( ( pad, ctypes.c_char * ( start - offset ) ) )
+                    offset = start
+            if code == 'x':
+                pad = '_pad_%d' % len( fields )
+                fields.append( ( pad, ctypes.c_char * count ) )
+            elif code == 's':
+                fields.append( ( next( names ), ctypes.c_char * count ) )
+            elif ctype is not None:
+                for i in range( count ):
+                    fields.append( ( next( names ), ctype ) )
+            else:
+                raise ValueError( 'unsupported ctypes format: %s' % code )
+            prefix += '%d%s' % ( count, code )
+            offset  = struct.calcsize( prefix )
 
-                # Assign this data to a generated field name
-                else:
-                    setattr( obj, '_anon_' + i, parts[ i ] )
+        # Create the class
+        cls = type( name, ( base, ), { '_fields_' : fields, '_pack_' : 1 } )
+        if ctypes.sizeof( cls ) != self.sizeof:
+            raise ValueError(
+                'ctypes layout (%d bytes) does not match format (%d bytes)'
+                % ( ctypes.sizeof( cls ), self.sizeof )
+            )
+        return cls
 
-        # Data properly loaded
-        return True
+
+    #=========================================================================
+    def view( self, buffer, offset = 0, count = None ):
+        """
+        Create a zero-copy view of record(s) in a writable buffer.  Members of
+        the view read from (and write to) the buffer directly.  Read-only
+        buffers (strings, read-only mmaps, etc) can not be shared, so the
+        view is a copy of the records (changes are not written back).
+        @param buffer Buffer containing the record(s) (see above)
+        @param offset Byte offset of the first record in the buffer
+        @param count Number of records to view as an array (default is a
+                     single record)
+        @return ctypes.Structure (or array of ctypes.Structure) instance
+        """
+
+        # The ctypes class is only generated once
+        if self._ctype is None:
+            self._ctype = self.ctype()
+
+        cls = self._ctype if count is None else ( self._ctype * count )
+        try:
+            return cls.from_buffer( buffer, offset )
+        except TypeError:
+            return cls.from_buffer_copy( buffer, offset )
 
 
     #=========================================================================
@@ -93,7 +256,7 @@ class structure:
         @param *args Data values to pack according to structure format
         @return Byte string of packed data
         """
-        return struct.pack( self.format, *args )
+        return self.struct.pack( *args )
 
     #=========================================================================
     def pack_from_object( self, obj ):
@@ -111,6 +274,588 @@ class structure:
         return self.pack( *args )
 
 
+    #=========================================================================
+    def _iter_file( self, handle, offset ):
+        """
+        Iterate over records read from a file in large blocks.
+        """
+
+        # Move to the first record
+        if offset > 0:
+            handle.seek( offset )
+
+        # Read blocks of records, carrying partial records to the next block
+        size  = self.sizeof * _records_per_read
+        extra = ''
+        while True:
+            block = handle.read( size )
+            if len( block ) == 0:
+                break
+            if len( extra ) > 0:
+                block = extra + block
+            end = len( block ) - ( len( block ) % self.sizeof )
+            for position in xrange( 0, end, self.sizeof ):
+                yield self.struct.unpack_from( block, position )
+            extra = block[ end : ]
+
+
+    #=========================================================================
+    def _load_parts( self, obj, parts ):
+        """
+        Assign unpacked values to a dictionary or an object's members.
+        """
+
+        # Assign all the values to the dictionary at once
+        if type( obj ) is dict:
+            obj.update( zip( self.names, parts ) )
+
+        # Assign each value to a member of the field's name
+        else:
+            for name, part in zip( self.names, parts ):
+                setattr( obj, name, part )
+
+
+#=============================================================================
+class record_file:
+    """
+    Memory-mapped file of fixed-size records described by a structure.
+    Records are accessed by record number without reading the whole file.
+    Slicing returns a lazy view of the same file (nothing is unpacked until a
+    record is accessed).  Views share the file's mapping: closing a view
+    only releases the view, and closing the file invalidates its views.  Records are returned as tuples of values (see the
+    structure's names for the field name of each value).
+    """
+
+
+    #=========================================================================
+    def __init__( self, structure, filename, writable = False, offset = 0 ):
+        """
+        Constructor
+        @param structure The structure describing each record
+        @param filename Path to the record file
+        @param writable Set to allow records to be modified in place
+        @param offset Byte offset of the first record (e.g. to skip a header)
+        """
+
+        self.structure = structure
+        self.filename  = filename
+        self.writable  = writable
+
+        # Map the file into memory (empty files can not be mapped)
+        self._handle = open( filename, 'r+b' if writable == True else 'rb' )
+        size = os.fstat( self._handle.fileno() ).st_size
+        if size > 0:
+            self._map = mmap.mmap(
+                self._handle.fileno(),
+                0,
+                access = mmap.ACCESS_WRITE if writable == True \
+                    else mmap.ACCESS_READ
+            )
+        else:
+            self._map = None
+
+        # The view of records is described by a start, step, and count
+        self._owner = True
+        self._start = offset
+        self._step  = structure.sizeof
+        self._count = max( 0, ( size - offset ) // structure.sizeof )
+
+
+    #=========================================================================
+    def __getitem__( self, index ):
+        """
+        Unpack a record, or create a view of a slice of records.
+        @param index Record number or slice
+        @return Tuple of record values, or a record_file view
+        """
+
+        # Slices share the mapping, and adjust the range of records
+        if isinstance( index, slice ):
+            ( start, stop, step ) = index.indices( self._count )
+            view = copy.copy( self )
+            view._owner = False
+            view._start = self._start + ( start * self._step )
+            view._step  = self._step * step
+            view._count = len( xrange( start, stop, step ) )
+            return view
+
+        return self.structure.struct.unpack_from(
+            self._map,
+            self._position( index )
+        )
+
+
+    #=========================================================================
+    def __iter__( self ):
+        """
+        Iterate over each record in the view.
+        """
+        unpack_from = self.structure.struct.unpack_from
+        for index in xrange( self._count ):
+            yield unpack_from(
+                self._map,
+                self._start + ( index * self._step )
+            )
+
+
+    #=========================================================================
+    def __len__( self ):
+        """
+        Report the number of records in the view.
+        """
+        return self._count
+
+
+    #=========================================================================
+    def __setitem__( self, index, values ):
+        """
+        Pack a record directly into the file.
+        @param index Record number
+        @param values Sequence of record values
+        """
+        self.structure.struct.pack_into(
+            self._map,
+            self._position( index ),
+            *values
+        )
+
+
+    #=========================================================================
+    def bisect( self, field, value ):
+        """
+        Binary search for a value in a field by which the records are sorted.
+        @param field Field name (or value index) of the sorted key field
+        @param value Key value to find
+        @return The number of the first record with a key that is not less
+                than the value (len() if all keys are less than the value)
+        """
+
+        # Convert field names to the index of the value in each record
+        if type( field ) is str:
+            field = self.structure.names.index( field )
+
+        # Standard bisect_left over the records' key values
+        unpack_from = self.structure.struct.unpack_from
+        low  = 0
+        high = self._count
+        while low < high:
+            middle = ( low + high ) // 2
+            record = unpack_from(
+                self._map,
+                self._start + ( middle * self._step )
+            )
+            if record[ field ] < value:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+
+    #=========================================================================
+    def close( self ):
+        """
+        Flush any changes, and close the file (views of the file only release
+        their reference to the shared mapping).
+        """
+        if self._owner == False:
+            self._map = None
+            return
+        if self._map is not None:
+            if self.writable == True:
+                self._map.flush()
+            self._map.close()
+            self._map = None
+        self._handle.close()
+
+
+    #=========================================================================
+    def _position( self, index ):
+        """
+        Determine the byte position of a record in the view.
+        """
+        if index < 0:
+            index += self._count
+        if ( index < 0 ) or ( index >= self._count ):
+            raise IndexError( 'record index out of range' )
+        return self._start + ( index * self._step )
+
+
+#=============================================================================
+class composite:
+    """
+    Definition of a composite (nested and/or variable-length) data structure.
+    Parsed records are lazy: a record keeps a reference to the buffer, and
+    each member is only decoded (and only located, for members that follow
+    variable-length members) when it is first accessed.
+
+    Example:
+        packet = composite( [
+            ( 'header',   structure( '<HB', [ 'kind', 'flags' ] ) ),
+            ( 'nsamples', '<H' ),
+            ( 'samples',  array_field( '<h', 'nsamples' ) ),
+            ( 'name',     blob_field( prefix = '<B' ) )
+        ] )
+        record = packet.parse( data )
+        record.name
+        --> only the header, count, and name prefix are decoded to find it
+
+    Members are (name, type) tuples.  The member type is one of:
+        struct format string    a single value (or a tuple of values)
+        structure               a flat structure (decoded to a dictionary)
+        composite               a nested composite (decoded lazily)
+        array_field             an array with a fixed or counted length
+        blob_field              a length-prefixed (or counted) byte string
+    """
+
+
+    #=========================================================================
+    def __init__( self, members ):
+        """
+        Constructor
+        @param members List of (name, type) member tuples
+        """
+
+        self.names   = [ member[ 0 ] for member in members ]
+        self.members = [ _member( member[ 1 ] ) for member in members ]
+        self.index   = dict( ( n, i ) for ( i, n ) in enumerate( self.names ) )
+
+        # The size is known ahead of time if every member has a fixed size
+        sizes = [ member.sizeof for member in self.members ]
+        self.sizeof = None if None in sizes else sum( sizes )
+
+
+    #=========================================================================
+    def parse( self, buffer, offset = 0 ):
+        """
+        Parse a record from a buffer.  Nothing is decoded until a member of
+        the record is accessed.
+        @param buffer String, bytearray, memoryview, or mmap to read
+        @param offset Byte offset of the record in the buffer
+        @return lazy_record instance
+        """
+        return lazy_record( self, buffer, offset )
+
+
+    #=========================================================================
+    def decode( self, buffer, offset, record ):
+        return lazy_record( self, buffer, offset )
+
+
+    #=========================================================================
+    def size( self, buffer, offset, record ):
+        if self.sizeof is not None:
+            return self.sizeof
+        return lazy_record( self, buffer, offset ).size()
+
+
+#=============================================================================
+class array_field:
+    """
+    Composite member for an array of items.
+    """
+
+
+    #=========================================================================
+    def __init__( self, item, count ):
+        """
+        Constructor
+        @param item Type of each item (any composite member type)
+        @param count Number of items, or the name of an earlier member in the
+                     same record that holds the number of items
+        """
+
+        self.item  = _member( item )
+        self.count = count
+        if ( type( count ) is int ) and ( self.item.sizeof is not None ):
+            self.sizeof = count * self.item.sizeof
+        else:
+            self.sizeof = None
+
+
+    #=========================================================================
+    def decode( self, buffer, offset, record ):
+        return lazy_array( self.item, self._count( record ), buffer, offset )
+
+
+    #=========================================================================
+    def size( self, buffer, offset, record ):
+        count = self._count( record )
+        if self.item.sizeof is not None:
+            return count * self.item.sizeof
+        return lazy_array( self.item, count, buffer, offset ).size()
+
+
+    #=========================================================================
+    def _count( self, record ):
+        if type( self.count ) is int:
+            return self.count
+        return record[ self.count ]
+
+
+#=============================================================================
+class blob_field:
+    """
+    Composite member for a variable-length byte string.
+    """
+
+
+    #=========================================================================
+    def __init__( self, prefix = None, length = None ):
+        """
+        Constructor
+        @param prefix Struct format of a length value stored immediately
+                      before the data (e.g. '<I')
+        @param length Number of bytes, or the name of an earlier member in
+                      the same record that holds the number of bytes
+        """
+
+        self.prefix = struct.Struct( prefix ) if prefix is not None else None
+        self.length = length
+        if ( prefix is None ) and ( type( length ) is int ):
+            self.sizeof = length
+        else:
+            self.sizeof = None
+
+
+    #=========================================================================
+    def decode( self, buffer, offset, record ):
+        ( start, length ) = self._extent( buffer, offset, record )
+        return buffer[ start : ( start + length ) ]
+
+
+    #=========================================================================
+    def size( self, buffer, offset, record ):
+        ( start, length ) = self._extent( buffer, offset, record )
+        return ( start - offset ) + length
+
+
+    #=========================================================================
+    def _extent( self, buffer, offset, record ):
+        if self.prefix is not None:
+            length = self.prefix.unpack_from( buffer, offset )[ 0 ]
+            return ( ( offset + self.prefix.size ), length )
+        if type( self.length ) is int:
+            return ( offset, self.length )
+        return ( offset, record[ self.length ] )
+
+
+#=============================================================================
+class lazy_record:
+    """
+    Record parsed by a composite definition.  Members are accessed as
+    attributes or items, and are decoded when they are first accessed.
+    """
+
+
+    #=========================================================================
+    def __init__( self, definition, buffer, offset ):
+        """
+        Constructor
+        @param definition The composite definition of the record
+        @param buffer Buffer containing the record
+        @param offset Byte offset of the record in the buffer
+        """
+
+        self._definition = definition
+        self._buffer     = buffer
+        self._offsets    = [ offset ]
+        self._values     = {}
+
+
+    #=========================================================================
+    def __getattr__( self, name ):
+        if ( name[ : 1 ] != '_' ) and ( name in self._definition.index ):
+            return self[ name ]
+        raise AttributeError( name )
+
+
+    #=========================================================================
+    def __getitem__( self, name ):
+        try:
+            return self._values[ name ]
+        except KeyError:
+            pass
+        index = self._definition.index[ name ]
+        value = self._definition.members[ index ].decode(
+            self._buffer,
+            self._offset( index ),
+            self
+        )
+        self._values[ name ] = value
+        return value
+
+
+    #=========================================================================
+    def offset( self, name ):
+        """
+        Determine the byte offset of a member in the buffer.
+        @param name Name of the member
+        @return Byte offset of the member
+        """
+        return self._offset( self._definition.index[ name ] )
+
+
+    #=========================================================================
+    def size( self ):
+        """
+        Determine the number of bytes used by the record in the buffer.
+        """
+        if self._definition.sizeof is not None:
+            return self._definition.sizeof
+        return self._offset( len( self._definition.members ) ) \
+            - self._offsets[ 0 ]
+
+
+    #=========================================================================
+    def _offset( self, index ):
+        """
+        Locate a member by adding up the sizes of all members before it.
+        """
+        members = self._definition.members
+        offsets = self._offsets
+        while len( offsets ) <= index:
+            last = len( offsets ) - 1
+            offsets.append(
+                offsets[ last ]
+                + members[ last ].size( self._buffer, offsets[ last ], self )
+            )
+        return offsets[ index ]
+
+
+#=============================================================================
+class lazy_array:
+    """
+    Array of items parsed from a buffer.  Items are decoded when they are
+    first accessed.
+    """
+
+
+    #=========================================================================
+    def __init__( self, item, count, buffer, offset ):
+        """
+        Constructor
+        @param item Composite member type of each item
+        @param count Number of items in the array
+        @param buffer Buffer containing the array
+        @param offset Byte offset of the array in the buffer
+        """
+
+        self._item    = item
+        self._count   = count
+        self._buffer  = buffer
+        self._offsets = [ offset ]
+
+
+    #=========================================================================
+    def __getitem__( self, index ):
+        if isinstance( index, slice ):
+            indices = xrange( *index.indices( self._count ) )
+            return [ self[ i ] for i in indices ]
+        if index < 0:
+            index += self._count
+        if ( index < 0 ) or ( index >= self._count ):
+            raise IndexError( 'array index out of range' )
+        return self._item.decode( self._buffer, self._offset( index ), None )
+
+
+    #=========================================================================
+    def __iter__( self ):
+        for index in xrange( self._count ):
+            yield self[ index ]
+
+
+    #=========================================================================
+    def __len__( self ):
+        return self._count
+
+
+    #=========================================================================
+    def size( self ):
+        """
+        Determine the number of bytes used by the array in the buffer.
+        """
+        return self._offset( self._count ) - self._offsets[ 0 ]
+
+
+    #=========================================================================
+    def _offset( self, index ):
+        """
+        Locate an item by its index (directly for fixed-size items).
+        """
+        if self._item.sizeof is not None:
+            return self._offsets[ 0 ] + ( index * self._item.sizeof )
+        offsets = self._offsets
+        while len( offsets ) <= index:
+            last = len( offsets ) - 1
+            offsets.append(
+                offsets[ last ]
+                + self._item.size( self._buffer, offsets[ last ], None )
+            )
+        return offsets[ index ]
+
+
+#=============================================================================
+class _scalar_member:
+    """
+    Composite member for values described by a struct format string.
+    """
+
+
+    #=========================================================================
+    def __init__( self, format ):
+        self.struct = struct.Struct( format )
+        self.sizeof = self.struct.size
+
+
+    #=========================================================================
+    def decode( self, buffer, offset, record ):
+        values = self.struct.unpack_from( buffer, offset )
+        return values[ 0 ] if len( values ) == 1 else values
+
+
+    #=========================================================================
+    def size( self, buffer, offset, record ):
+        return self.sizeof
+
+
+#=============================================================================
+class _structure_member:
+    """
+    Composite member for a flat structure.
+    """
+
+
+    #=========================================================================
+    def __init__( self, structure ):
+        self.structure = structure
+        self.sizeof    = structure.sizeof
+
+
+    #=========================================================================
+    def decode( self, buffer, offset, record ):
+        values = {}
+        self.structure.load_from( values, buffer, offset )
+        return values
+
+
+    #=========================================================================
+    def size( self, buffer, offset, record ):
+        return self.sizeof
+
+
+#=============================================================================
+def _member( kind ):
+    """
+    Convert a composite member type into an object that can size and decode
+    the member.
+    """
+    if type( kind ) is str:
+        return _scalar_member( kind )
+    if isinstance( kind, structure ):
+        return _structure_member( kind )
+    return kind
+
+
 #=============================================================================
 def main( argv ):
     """ Test script execution entry point """